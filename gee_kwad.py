@@ -3,9 +3,27 @@
 Sub-annotate g-quadruplex motifs.
 """
 
-from sys    import argv,stdin,stderr,exit
-from string import maketrans
-from re     import compile as re_compile
+from sys          import argv,stdin,stdout,stderr,exit
+from string       import maketrans
+from re           import compile as re_compile
+from copy         import copy
+from math         import ceil
+from os           import fstat,lstat,fdopen,sysconf,unlink,lseek,SEEK_CUR,times
+from mmap         import mmap,ACCESS_READ
+from os.path      import exists as path_exists,basename
+from stat         import S_ISREG,S_ISSOCK
+from time         import time
+from heapq        import heappush,heappop,heappushpop
+from zlib         import compressobj,decompress,DEFLATED,MAX_WBITS
+from bisect       import bisect_right
+from json         import dumps as json_dumps
+from collections  import OrderedDict
+from threading    import Lock
+from cStringIO    import StringIO
+from signal       import signal,siginterrupt,setitimer,SIGTERM,SIGPROF,SIG_DFL, \
+                         ITIMER_PROF
+from socket       import socket,AF_UNIX,SOCK_STREAM,error as socket_error
+from SocketServer import ThreadingMixIn,UnixStreamServer,StreamRequestHandler
 
 
 programName    = "gee_kwad"
@@ -34,10 +52,73 @@ usage: cat bed_file | %s [options]
                        (this is the default)
   --nowarn:tail        don't warn the user about sequences with tails
   --parse=fourstems    parse with a preference for exactly four stems
+  --engine=<engine>    how the motif grammars are matched; <engine> is one of
+                         fast   one combined pattern per grammar
+                                (this is the default)
+                         regex  one pattern per grammar variant, tried in
+                                turn (the reference behavior)
+  --motif=<type>       the type of non-B DNA motif in the input; <type> is one
+                       of g4 (the default), direct, mirror, inverted, or z;
+                       types other than g4 are split into the parts (e.g.
+                       arm1, spacer, arm2) named by that type's grammar
+  --format=<layout>    how the sub-annotations are written; <layout> is one of
+                         parts  one bed line per stem, loop and tail
+                                (this is the default)
+                         bed12  one BED12 line per motif, spanning its
+                                stems, with the stems as blocks (the loops
+                                are the gaps); the name is the input
+                                interval, e.g. chr1:11009-11026 (1-based,
+                                inclusive); an empty loop (stems that abut)
+                                leaves no gap, so its blocks touch
+                         gff3   GFF3, a sequence_motif feature per motif
+                                with its stems, loops and tail as region
+                                children (part=stem, loop or tail); empty
+                                loops are omitted, since GFF3 can't express
+                                them
+  --indexed=<file>     write the sub-annotations to <file> as gzip-compressed
+                       blocks ordered by position, with an index in
+                       <file>.idx; the input must be grouped by chromosome
+                       and sorted by start position
+  --query=<region>     instead of processing the input, read the file given
+                       by --indexed and write the sub-annotations overlapping
+                       <region>, e.g. chr1:1,000,001-1,100,000 (1-based,
+                       inclusive) or chr1
+  --cache=<number>     keep the parse results of up to this many recently seen
+                       sequences, so repeated sequences are parsed only once
+  --server=<socket>    run as a long-lived server, accepting batches of bed
+                       lines from any number of clients on a unix-domain
+                       socket; the parse options are fixed by the server's
+                       command line
+  --server=stdio       run as a server, reading batches from stdin and
+                       writing the results to stdout
+  --connect=<socket>   send the input to a server on a unix-domain socket and
+                       write the results to the output
+  --batch=<number>     number of input lines sent in each batch with
+                       --connect (default is 10K)
   --copyinput          copy the input lines to the output, as comments with
                        a "#" prefix
+  --windows=<size>     instead of the sub-annotations, output a table of the
+                       number and total length of stems, loops and tails in
+                       each genomic window of the given size (e.g. 1M); input
+                       must be grouped by chromosome
+  --windows=<bed_file> same as --windows=<size>, but with the windows given by
+                       the first three columns of a bed file
+  --nommap             read the input line by line, even when it is a regular
+                       file (by default a regular file is memory-mapped)
   --head=<number>      limit the number of input lines
   --progress=<number>  periodically report how many lines we've read
+  --telemetry=<file>   periodically write throughput telemetry to a file, as
+                       JSON lines; <file> can be fd:<number> to write to an
+                       already-open file descriptor
+  --telemetry:interval=<seconds>  how often to write telemetry
+                       (default is 10 seconds)
+  --telemetry:slowest=<number>  how many of the slowest records to report
+                       (default is 5)
+  --profile=<file>     sample where the cpu time goes, and write a table of
+                       the time spent in each function to <file>, and the
+                       sampled call stacks to <file>.folded (in the collapsed
+                       format used by flamegraph tools)
+  --profile:interval=<seconds>  how often to sample (default is 0.001)
   --version            show version number and quit
 
 The <bed_file> contains lines that look like this:
@@ -60,10 +141,8 @@ break those g-quadruplexes into stems and loops.""" \
 
 
 def main():
-	global allowBulges,allowGLoops,allowBadLength
-	global debug
 
-    # parse the command line
+	# parse the command line
 
 	allowBulges     = False
 	allowGLoops     = True
@@ -72,9 +151,25 @@ def main():
 	warnOnBulges    = False
 	warnOnTails     = True
 	parseAs         = "latest version"
+	engine          = "fast"
+	motifType       = "g4"
+	outputFormat    = "parts"
 	copyInputLines  = False
+	windowSpec      = None
+	indexedName     = None
+	queryRegion     = None
+	cacheSize       = 0
+	serverAddress   = None
+	clientAddress   = None
+	clientBatchSize = 10*1000
+	useMmap         = True
 	headLimit       = None
 	reportProgress  = None
+	telemetryName   = None
+	telemetryEvery  = 10.0
+	telemetrySlow   = 5
+	profileName     = None
+	profileEvery    = 0.001
 	debug           = []
 
 	for arg in argv[1:]:
@@ -116,12 +211,65 @@ def main():
 			warnOnTails = False
 		elif (arg in ["--parse=fourstems","--parse=4stems"]):
 			parseAs = "4 stems"
+		elif (arg.startswith("--engine=")):
+			engine = argVal
+			if (engine not in gQuadEngines):
+				usage("unknown engine: %s" % arg)
+		elif (arg.startswith("--motif=")):
+			motifType = argVal.lower()
+			if (motifType not in ["g4"] + motifGrammars.keys()):
+				usage("unknown motif type: %s" % arg)
+		elif (arg.startswith("--format=")):
+			outputFormat = argVal.lower()
+			if (outputFormat not in ["parts","bed12","gff3"]):
+				usage("unknown output format: %s" % arg)
 		elif (arg in ["--copyinput","--copylines"]):
 			copyInputLines = True
+		elif (arg.startswith("--windows=")):
+			windowSpec = argVal
+		elif (arg.startswith("--indexed=")):
+			indexedName = argVal
+		elif (arg.startswith("--query=")):
+			queryRegion = argVal
+		elif (arg.startswith("--cache=")):
+			cacheSize = int_with_unit(argVal)
+		elif (arg.startswith("--server=")):
+			serverAddress = argVal
+		elif (arg.startswith("--connect=")):
+			clientAddress = argVal
+		elif (arg.startswith("--batch=")):
+			clientBatchSize = int_with_unit(argVal)
+			if (clientBatchSize <= 0):
+				usage("batch size must be positive: %s" % arg)
+		elif (arg in ["--nommap","--no:mmap"]):
+			useMmap = False
 		elif (arg.startswith("--head=")):
 			headLimit = int_with_unit(argVal)
 		elif (arg.startswith("--progress=")):
 			reportProgress = int_with_unit(argVal)
+		elif (arg.startswith("--telemetry=")):
+			telemetryName = argVal
+			if (telemetryName == ""):
+				usage("telemetry file name is missing: %s" % arg)
+			if (telemetryName.startswith("fd:")):
+				try:
+					telemetryFd = int(telemetryName[3:])
+				except ValueError:
+					telemetryFd = -1
+				if (telemetryFd < 0):
+					usage("telemetry file descriptor must be a non-negative integer: %s" % arg)
+		elif (arg.startswith("--telemetry:interval=")):
+			telemetryEvery = float(argVal)
+			if (telemetryEvery <= 0):
+				usage("telemetry interval must be positive: %s" % arg)
+		elif (arg.startswith("--telemetry:slowest=")):
+			telemetrySlow = int_with_unit(argVal)
+		elif (arg.startswith("--profile=")):
+			profileName = argVal
+		elif (arg.startswith("--profile:interval=")):
+			profileEvery = float(argVal)
+			if (profileEvery <= 0):
+				usage("profile interval must be positive: %s" % arg)
 		elif (arg in ["--version","--v","--V","-version","-v","-V"]):
 			exit("%s, version %s" % (programName,programVersion))
 		elif (arg == "--debug"):
@@ -133,55 +281,232 @@ def main():
 		else:
 			usage("unrecognized option: %s" % arg)
 
+	if (windowSpec != None) and (motifType != "g4"):
+		usage("--windows can't be used with --motif=%s" % motifType)
+
+	if (outputFormat != "parts"):
+		if (motifType != "g4"):
+			usage("--format=%s can't be used with --motif=%s" % (outputFormat,motifType))
+		if (windowSpec != None):
+			usage("--format=%s can't be used with --windows" % outputFormat)
+		if (indexedName != None):
+			usage("--format=%s can't be used with --indexed" % outputFormat)
+		if (outputFormat == "gff3") and (serverAddress != None):
+			usage("--format=gff3 can't be used with --server")
+
+	if (queryRegion != None) and (indexedName == None):
+		usage("--query requires --indexed")
+	if (indexedName != None) and (queryRegion == None):
+		if (windowSpec != None):
+			usage("--indexed can't be used with --windows")
+		if (motifType != "g4"):
+			usage("--indexed can't be used with --motif=%s" % motifType)
+		if (serverAddress != None) or (clientAddress != None):
+			usage("--indexed can't be used with --server or --connect")
+
+	if (profileName != None):
+		if (queryRegion != None) or (serverAddress != None) or (clientAddress != None):
+			usage("--profile can't be used with --query, --server or --connect")
+
+	# if we're asked for a region of an indexed file, just look it up
+
+	if (queryRegion != None):
+		try:
+			region = parse_region(queryRegion)
+		except ValueError:
+			usage("bad region: --query=%s" % queryRegion)
+		for (chrom,start,end,line) in query_indexed(indexedName,*region):
+			print line
+		return
+
+	if (serverAddress != None) and (clientAddress != None):
+		usage("--server and --connect can't be used together")
+	if (serverAddress != None) or (clientAddress != None):
+		if (windowSpec != None):
+			usage("--windows can't be used with --server or --connect")
+		if (telemetryName != None):
+			usage("--telemetry can't be used with --server or --connect")
+
+	# if we're a client, just pass the input along to the server
+
+	if (clientAddress != None):
+		run_client(clientAddress,stdin,stdout,batchSize=clientBatchSize)
+		return
+
 	# process the putative g-quadruplex motifs
 
-	gQuadParser = parse_as_g_quad
-	if (parseAs == "4 stems"): gQuadParser = parse_as_g_quad_4_stems
+	profiler = None
+	if (profileName != None):
+		profiler = SamplingProfiler(interval=profileEvery)
+		profiler.start()
+
+	parser = GQuadParser(allowBulges=allowBulges,
+	                     allowGLoops=allowGLoops,
+	                     parseAs=parseAs,
+	                     engine=engine,
+	                     cacheSize=cacheSize,
+	                     debug=debug)
+
+	motifMatcher = None
+	if (motifType != "g4"):
+		motifMatcher = motifGrammars[motifType].compile(combined=(engine=="fast"))
+
+	inputSize = regular_file_size(stdin)
+	if (inputSize == None): useMmap = False
+
+	telemetry = None
+	if (telemetryName != None):
+		if (telemetryName.startswith("fd:")):
+			try:
+				telemetryF = fdopen(int(telemetryName[3:]),"wt")
+			except OSError, ex:
+				usage("can't write telemetry to %s (%s)" % (telemetryName,ex.strerror))
+		else:
+			telemetryF = file(telemetryName,"wt")
+		telemetry = Telemetry(telemetryF,
+		                      interval=telemetryEvery,
+		                      numSlowest=telemetrySlow,
+		                      inputSize=inputSize)
+		if (parser.cache != None): telemetry.cacheStats = parser.cache_stats
+
+	if (useMmap):
+		g4Source = read_gquad_bed_mapped(stdin,allowBadLength=allowBadLength,tally=telemetry)
+	else:
+		inF = stdin if (telemetry == None) else telemetry.count_input(stdin)
+		g4Source = read_gquad_bed(inF,allowBadLength=allowBadLength)
+
+	windowTally = None
+	if (windowSpec != None):
+		try:
+			windowSize = int_with_unit(windowSpec)
+			windowList = None
+		except ValueError:
+			windowSize = None
+			f = file(windowSpec,"rt")
+			windowList = read_windows_bed(f,windowSpec)
+			f.close()
+		if (windowSize != None) and (windowSize <= 0):
+			usage("window size must be positive: --windows=%s" % windowSpec)
+		windowTally = WindowTally(windowSize=windowSize,windows=windowList)
+
+	indexedWriter = None
+	if (indexedName != None):
+		indexedWriter = IndexedPartWriter(indexedName)
+
+	warnOn = []
+	if (warnOnBulges):    warnOn += ["bulges"]
+	if (warnOnLongLoops): warnOn += ["long loops"]
+	if (warnOnTails):     warnOn += ["tails"]
+
+	annotator = MotifAnnotator(parser,
+	                           motifMatcher=motifMatcher,
+	                           warnOn=warnOn,
+	                           copyInputLines=copyInputLines,
+	                           outputFormat=outputFormat,
+	                           windowTally=windowTally,
+	                           indexedWriter=indexedWriter)
+
+	if (serverAddress != None):
+		run_server(serverAddress,annotator,allowBadLength=allowBadLength)
+		return
+
+	if (outputFormat == "gff3"):
+		print "##gff-version 3"
 
 	itemNum = 0
-	for g4 in read_gquad_bed(stdin):
+	for g4 in g4Source:
 		itemNum += 1
 		if (headLimit != None) and (itemNum > headLimit):
 			print >>stderr, "limit of %s items reached" % (commatize(headLimit))
 			break
+		if (telemetry != None): telemetry.tick(g4)
 		if (reportProgress != None) and (itemNum % reportProgress == 0):
 			print >>stderr, "progress: item %s (%s %d %d)" \
 			              % (commatize(itemNum),g4.chrom,g4.start,g4.end)
 
+		annotator.annotate(g4)
+
+	if (windowTally != None):
+		windowTally.finish()
+
+	if (indexedWriter != None):
+		indexedWriter.finish()
+
+	if (telemetry != None):
+		telemetry.finish()
+		telemetryF.close()
+
+	if (profiler != None):
+		profiler.stop()
+		f = file(profileName,"wt")
+		profiler.write_table(f)
+		f.close()
+		f = file(profileName+".folded","wt")
+		profiler.write_folded(f)
+		f.close()
+
+
+# MotifAnnotator--
+#	Sub-annotate motif records and write the results.
+#
+# This holds the choices about what to write (and what to warn about) so
+# that the same job can be run from main() or on behalf of server clients.
+# Sub-annotations go to out, unless a WindowTally or IndexedPartWriter is
+# given to collect them instead. Without one of those, an annotator is not
+# modified after construction and can be shared by several threads.
+
+class MotifAnnotator:
+	def __init__(self,parser,motifMatcher=None,warnOn=None,copyInputLines=False,
+	             outputFormat="parts",windowTally=None,indexedWriter=None):
+		if (outputFormat not in ["parts","bed12","gff3"]):
+			raise ValueError("unknown output format: \"%s\"" % outputFormat)
+
+		self.parser         = parser
+		self.motifMatcher   = motifMatcher
+		self.warnOn         = [] if (warnOn == None) else list(warnOn)
+		self.copyInputLines = copyInputLines
+		self.outputFormat   = outputFormat
+		self.motifsWritten  = 0   # (used to give gff3 features unique ids)
+		self.windowTally    = windowTally
+		self.indexedWriter  = indexedWriter
+
+	# annotate--
+	#	Sub-annotate one record (as yielded by read_gquad_bed), writing the
+	#	sub-annotations to out and any warnings to err.
+
+	def annotate(self,g4,out=None,err=None):
+		if (out == None): out = stdout
+		if (err == None): err = stderr
+		copyInputLines = self.copyInputLines
+		windowTally    = self.windowTally
+		indexedWriter  = self.indexedWriter
+
+		if (self.motifMatcher != None):
+			write_motif_parts(g4,self.motifMatcher,copyInputLines,out,err)
+			return
+
 		# parse the motif
 
-		strand = g4.strand
-		if (strand == "+"):
-			parts = gQuadParser(g4.motifSeq)
-		elif (strand == "-"):
-			motifRev = reverse_complement(g4.motifSeq)
-			parts = gQuadParser(motifRev)
-		else: # if (strand == None):
-			parts = gQuadParser(g4.motifSeq)
-			if (parts != None):
-				strand = "+"
-			else:
-				motifRev = reverse_complement(g4.motifSeq)
-				parts = gQuadParser(motifRev)
-				if (parts != None):
-					strand = "-"
+		parts  = self.parser.parse_record(g4.chrom,g4.start,g4.end,g4.motifSeq,g4.strand,
+		                                  allowMirrored=True)
+		strand = g4.strand if (parts == None) else parts.strand
 
 		# report any warnings to the user and/or to the output
 
-		if (warnOnBulges) and (parts != None) and (parts.hasBulge):
-			print >>stderr, "WARNING: bulge in %s %d %d: %s" \
-			              % (g4.chrom,g4.start,g4.end,g4.motifSeq)
+		if ("bulges" in self.warnOn) and (parts != None) and (parts.hasBulge):
+			write_warning(err,"WARNING: bulge in %s %d %d: %s" \
+			                % (g4.chrom,g4.start,g4.end,g4.motifSeq))
 
-		if (warnOnLongLoops) and (parts != None) and (parts.hasLongLoop):
-			print >>stderr, "WARNING: long loop in %s %d %d: %s" \
-			              % (g4.chrom,g4.start,g4.end,g4.motifSeq)
+		if ("long loops" in self.warnOn) and (parts != None) and (parts.hasLongLoop):
+			write_warning(err,"WARNING: long loop in %s %d %d: %s" \
+			                % (g4.chrom,g4.start,g4.end,g4.motifSeq))
 
-		if (warnOnTails) and (parts != None) and (parts.tail != None):
-			print >>stderr, "WARNING: tail in %s %d %d: %s" \
-			              % (g4.chrom,g4.start,g4.end,g4.motifSeq)
+		if ("tails" in self.warnOn) and (parts != None) and (parts.tail != None):
+			write_warning(err,"WARNING: tail in %s %d %d: %s" \
+			                % (g4.chrom,g4.start,g4.end,g4.motifSeq))
 
-		if (copyInputLines):
-			print "# %s" % g4.line
+		if (copyInputLines) and (windowTally == None) and (indexedWriter == None):
+			print >>out, "# %s" % g4.line
 
 		stemLoopInconsistency = (parts != None) and (len(parts.stem) != len(parts.loop)+1)
 		if (parts == None) or (stemLoopInconsistency):
@@ -190,94 +515,397 @@ def main():
 			else:
 				message = "unable to sub-annotate"
 
-			if (copyInputLines):
-				print "# (%s)" % message
+			if (windowTally != None):
+				windowTally.add_unparsed(g4.chrom,g4.start,g4.end)
+			elif (indexedWriter != None):
+				indexedWriter.add_motif(g4.chrom,g4.start,[])
+			elif (copyInputLines):
+				print >>out, "# (%s)" % message
 			else:
-				print "# %s %s" % (message,g4.line)
+				print >>out, "# %s %s" % (message,g4.line)
 
 			if (strand != None):
-				print >>stderr, "WARNING: unable to sub-annotate %s %d %d %s: %s" \
-				              % (g4.chrom,g4.start,g4.end,g4.strand,g4.motifSeq)
+				write_warning(err,"WARNING: unable to sub-annotate %s %d %d %s: %s" \
+				                % (g4.chrom,g4.start,g4.end,g4.strand,g4.motifSeq))
 			else:
-				print >>stderr, "WARNING: unable to sub-annotate %s %d %d: %s" \
-				              % (g4.chrom,g4.start,g4.end,g4.motifSeq)
-			continue
+				write_warning(err,"WARNING: unable to sub-annotate %s %d %d: %s" \
+				                % (g4.chrom,g4.start,g4.end,g4.motifSeq))
+			return
 
 		# output the sub-annotations
 
-		numStems = len(parts.stem)
-
-		if (strand == "+"):
-			stemStart = g4.start
-			for stemIx in xrange(numStems):
-				stemEnd = stemStart + len(parts.stem[stemIx])
-				print "%s\t%d\t%d\t%s\t%d\t%s\tstem%d" \
-				    % (g4.chrom,stemStart,stemEnd,
-				       parts.stem[stemIx],len(parts.stem[stemIx]),
-				       strand,1+stemIx)
-
-				if (stemIx == numStems-1): break
-
-				loopStart = stemEnd
-				loopEnd   = loopStart + len(parts.loop[stemIx])
-				print "%s\t%d\t%d\t%s\t%d\t%s\tloop%d" \
-				    % (g4.chrom,loopStart,loopEnd,
-				       parts.loop[stemIx],len(parts.loop[stemIx]),
-				       strand,1+stemIx)
-
-				stemStart = loopEnd
-
-			if (parts.tail == None):
-				assert (stemEnd == g4.end)
-			else:
-				tailStart = stemEnd
-				tailEnd   = tailStart + len(parts.tail)
-				assert (tailEnd == g4.end)
-
-			if (parts.tail != None):
-				print "%s\t%d\t%d\t%s\t%d\t%s\ttail" \
-				    % (g4.chrom,tailStart,tailEnd,
-				       parts.tail,len(parts.tail),
-				       strand)
-
-		else: # if (strand == "-"):
-			stemStart = g4.end
-			for stemIx in xrange(numStems):
-				stemEnd = stemStart - len(parts.stem[stemIx])
-				print "%s\t%d\t%d\t%s\t%d\t%s\tstem%d" \
-				    % (g4.chrom,stemEnd,stemStart,
-				       reverse_complement(parts.stem[stemIx]),len(parts.stem[stemIx]),
-				       strand,1+stemIx)
-
-				if (stemIx == numStems-1): break
-
-				loopStart = stemEnd
-				loopEnd   = loopStart - len(parts.loop[stemIx])
-				print "%s\t%d\t%d\t%s\t%d\t%s\tloop%d" \
-				    % (g4.chrom,loopEnd,loopStart,
-				       reverse_complement(parts.loop[stemIx]),len(parts.loop[stemIx]),
-				       strand,1+stemIx)
-
-				stemStart = loopEnd
-
-			if (parts.tail == None):
-				assert (stemEnd == g4.start)
-			else:
-				tailStart = stemEnd
-				tailEnd   = tailStart - len(parts.tail)
-				assert (tailEnd == g4.start)
-
-			if (parts.tail != None):
-				print "%s\t%d\t%d\t%s\t%d\t%s\ttail" \
-				    % (g4.chrom,tailEnd,tailStart,
-				       reverse_complement(parts.tail),len(parts.tail),
-				       strand)
+		if (windowTally != None):
+			windowTally.add_motif(g4.chrom,g4.start,g4.end,
+			                      part_intervals(g4,strand,parts,withSeq=False))
+			return
+
+		if (indexedWriter != None):
+			lines = []
+			for (start,end,kind,num,seq) in part_intervals(g4,strand,parts):
+				label = kind if (num == None) else "%s%d" % (kind,num)
+				lines += [(start,end,"%s\t%d\t%d\t%s\t%d\t%s\t%s" \
+				                   % (g4.chrom,start,end,seq,end-start,strand,label))]
+			indexedWriter.add_motif(g4.chrom,g4.start,lines)
+			return
+
+		if (self.outputFormat == "bed12"):
+			write_bed12_motif(g4,strand,parts,out)
+			return
+
+		if (self.outputFormat == "gff3"):
+			self.motifsWritten += 1
+			write_gff3_motif(g4,strand,parts,"g4_%d" % self.motifsWritten,out)
+			return
+
+		write_parts_motif(g4,strand,parts,out)
+
+
+# write_parts_motif--
+#	Write a parsed motif as one bed line per stem, loop and tail (the default
+#	layout). This is part_intervals unrolled, since it is on the hot path; the
+#	lines are the same.
+
+def write_parts_motif(g4,strand,parts,out):
+	chrom = g4.chrom
+	stems = parts.stem
+	loops = parts.loop
+	lines = []
+	if (strand == "+"):
+		partStart = g4.start
+		for (ix,stem) in enumerate(stems):
+			if (ix > 0):
+				loop = loops[ix-1]
+				partEnd = partStart + len(loop)
+				lines += ["%s\t%d\t%d\t%s\t%d\t+\tloop%d" \
+				          % (chrom,partStart,partEnd,loop,partEnd-partStart,ix)]
+				partStart = partEnd
+			partEnd = partStart + len(stem)
+			lines += ["%s\t%d\t%d\t%s\t%d\t+\tstem%d" \
+			          % (chrom,partStart,partEnd,stem,partEnd-partStart,ix+1)]
+			partStart = partEnd
+		if (parts.tail != None):
+			partEnd = partStart + len(parts.tail)
+			lines += ["%s\t%d\t%d\t%s\t%d\t+\ttail" \
+			          % (chrom,partStart,partEnd,parts.tail,partEnd-partStart)]
+		assert (partEnd == g4.end)
+
+	else: # if (strand == "-"):
+		seq = g4.motifSeq
+		seqStart = g4.start
+		partEnd = g4.end
+		for (ix,stem) in enumerate(stems):
+			if (ix > 0):
+				partStart = partEnd - len(loops[ix-1])
+				text = seq[partStart-seqStart:partEnd-seqStart]
+				lines += ["%s\t%d\t%d\t%s\t%d\t-\tloop%d" \
+				          % (chrom,partStart,partEnd,text,partEnd-partStart,ix)]
+				partEnd = partStart
+			partStart = partEnd - len(stem)
+			text = seq[partStart-seqStart:partEnd-seqStart]
+			lines += ["%s\t%d\t%d\t%s\t%d\t-\tstem%d" \
+			          % (chrom,partStart,partEnd,text,partEnd-partStart,ix+1)]
+			partEnd = partStart
+		if (parts.tail != None):
+			partStart = partEnd - len(parts.tail)
+			text = seq[partStart-seqStart:partEnd-seqStart]
+			lines += ["%s\t%d\t%d\t%s\t%d\t-\ttail" \
+			          % (chrom,partStart,partEnd,text,partEnd-partStart)]
+		assert (partStart == g4.start)
+
+	lines += [""]
+	out.write("\n".join(lines))
+
+
+# write_bed12_motif--
+#	Write a parsed motif as a single BED12 line. The line spans the stems
+#	(any tail is left out), each stem is a block, and the loops are the gaps
+#	between blocks; an empty loop leaves two blocks abutting. The name is
+#	the motif's input interval, 1-based.
+
+def write_bed12_motif(g4,strand,parts,out):
+	stems = [(start,end) for (start,end,kind,num,seq)
+	                     in part_intervals(g4,strand,parts,withSeq=False)
+	                     if (kind == "stem")]
+	stems.sort()
+	chromStart = stems[0][0]
+	chromEnd   = stems[-1][1]
+
+	print >>out, "%s\t%d\t%d\t%s:%d-%d\t0\t%s\t%d\t%d\t0\t%d\t%s\t%s" \
+	           % (g4.chrom,chromStart,chromEnd,
+	              g4.chrom,g4.start+1,g4.end,strand,
+	              chromStart,chromEnd,len(stems),
+	              ",".join(["%d" % (end-start)        for (start,end) in stems]),
+	              ",".join(["%d" % (start-chromStart) for (start,end) in stems]))
+
+
+# write_gff3_motif--
+#	Write a parsed motif as GFF3 features: a sequence_motif covering the
+#	input interval, with its stems, loops and tail as region child features.
+#	Column 3 must be a Sequence Ontology term, and SO has none for the parts
+#	of a g-quadruplex, so the part's label goes in Name and its kind in a
+#	part attribute. Coordinates are 1-based and inclusive. Empty loops are
+#	left out, since a GFF3 feature must cover at least one base; the
+#	remaining parts keep their numbers.
+
+def write_gff3_motif(g4,strand,parts,motifId,out):
+	print >>out, "%s\t%s\tsequence_motif\t%d\t%d\t.\t%s\t.\tID=%s;Name=%s:%d-%d;motif=G_quadruplex" \
+	           % (g4.chrom,programName,g4.start+1,g4.end,strand,
+	              motifId,g4.chrom,g4.start+1,g4.end)
+
+	for (start,end,kind,num,seq) in part_intervals(g4,strand,parts):
+		if (start == end): continue
+		label = kind if (num == None) else "%s%d" % (kind,num)
+		print >>out, "%s\t%s\tregion\t%d\t%d\t.\t%s\t.\tParent=%s;Name=%s;part=%s;sequence=%s" \
+		           % (g4.chrom,programName,start+1,end,strand,motifId,label,kind,seq)
+
+
+# run_server--
+#	Serve sub-annotation requests, either on a unix-domain socket or on
+#	stdin/stdout.
+#
+# The protocol is line-based. A client sends a batch of bed lines (in the
+# same format as our normal input) followed by a line containing only
+# "##end-of-batch". The server replies with the output lines for that batch
+# followed by the same marker line. If the batch has a bad line, the reply is
+# instead a single "##error <message>" line (and the marker). A client may
+# send any number of batches on one connection. Warnings are written to the
+# server's stderr.
+#
+# A batch may begin with a "##first-line <number>" line, giving the input line
+# number of the batch's first bed line; errors then refer to lines of the
+# client's input, rather than to lines of the batch.
+#
+# Socket clients are each handled in their own thread, all sharing the same
+# annotator (and thus the same compiled grammars and parse cache).
+
+batchEndMarker = "##end-of-batch"
+batchFirstLine = "##first-line "
+
+def run_server(address,annotator,allowBadLength=False):
+	if (address == "stdio"):
+		for lines in read_batches(stdin):
+			serve_batch(annotator,lines,stdout,allowBadLength)
+		return
+
+	try:
+		addressMode = lstat(address).st_mode
+	except OSError:
+		addressMode = None
+
+	if (addressMode != None):
+		# remove the socket left behind by a server that's no longer running;
+		# anything else at that path is not ours to remove
+		if (not S_ISSOCK(addressMode)):
+			exit("%s: %s exists and is not a socket" % (programName,address))
+		probe = socket(AF_UNIX,SOCK_STREAM)
+		try:
+			probe.connect(address)
+			probe.close()
+			exit("%s: a server is already running on %s" % (programName,address))
+		except socket_error:
+			unlink(address)
+
+	server = GQuadServer(address,GQuadRequestHandler)
+	server.annotator      = annotator
+	server.allowBadLength = allowBadLength
+	signal(SIGTERM,lambda signum,frame: exit(0))
+	print >>stderr, "%s: serving on %s" % (programName,address)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if (path_exists(address)): unlink(address)
+
+
+class GQuadServer(ThreadingMixIn,UnixStreamServer):
+	daemon_threads = True
+
+
+class GQuadRequestHandler(StreamRequestHandler):
+	def handle(self):
+		try:
+			for lines in read_batches(self.rfile):
+				serve_batch(self.server.annotator,lines,self.wfile,
+				            self.server.allowBadLength)
+		except socket_error:
+			pass  # the client went away
+
+	def finish(self):
+		# flushing a reply to a client that has gone away fails again here
+		try:
+			StreamRequestHandler.finish(self)
+		except socket_error:
+			pass
+
+
+# read_batches--
+#	Yield batches of lines, as separated by end-of-batch markers. Lines are
+#	read one at a time, rather than with python's read-ahead file iterator,
+#	so that we never wait for input beyond the end of a batch.
+
+def read_batches(f):
+	lines = []
+	for line in iter(f.readline,""):
+		if (line.rstrip() == batchEndMarker):
+			yield lines
+			lines = []
+		else:
+			lines += [line]
+	if (lines != []):
+		yield lines
 
 
-# parse_as_g_quad--
-#	Try to parse a sequence, in its entirety, as a g-qudruplex motif.  If
-#	succesful, return an object describing the parts of the motif. Otherwise,
-#	return None.
+def serve_batch(annotator,lines,out,allowBadLength=False):
+	(fName,firstLine) = ("batch",1)
+	if (lines != []) and (lines[0].startswith(batchFirstLine)):
+		try:
+			(fName,firstLine) = ("input",int(lines[0][len(batchFirstLine):]))
+			lines = lines[1:]
+		except ValueError:
+			pass
+
+	reply = StringIO()
+	try:
+		for g4 in read_gquad_bed(lines,fName=fName,firstLine=firstLine,
+		                         allowBadLength=allowBadLength):
+			annotator.annotate(g4,reply)
+		out.write(reply.getvalue())
+	except AssertionError, ex:
+		out.write("##error %s\n" % " ".join(str(ex).split("\n")))
+	out.write(batchEndMarker + "\n")
+	out.flush()
+
+
+# run_client--
+#	Send bed lines to a server, in batches, and copy the replies to out.
+
+def run_client(address,f,out,batchSize=10*1000):
+	sock = socket(AF_UNIX,SOCK_STREAM)
+	try:
+		sock.connect(address)
+	except socket_error, ex:
+		exit("%s: unable to connect to %s (%s)" % (programName,address,ex))
+	toServer   = sock.makefile("wb")
+	fromServer = sock.makefile("rb")
+
+	batch     = []
+	firstLine = 1
+	for line in f:
+		batch += [line if (line.endswith("\n")) else line+"\n"]
+		if (len(batch) >= batchSize):
+			client_batch(batch,firstLine,toServer,fromServer,out)
+			firstLine += len(batch)
+			batch = []
+	if (batch != []):
+		client_batch(batch,firstLine,toServer,fromServer,out)
+
+	toServer.close()
+	fromServer.close()
+	sock.close()
+
+
+def client_batch(lines,firstLine,toServer,fromServer,out):
+	toServer.write("%s%d\n" % (batchFirstLine,firstLine))
+	toServer.writelines(lines)
+	toServer.write(batchEndMarker + "\n")
+	toServer.flush()
+	error = None
+	for line in iter(fromServer.readline,""):
+		if (line.rstrip() == batchEndMarker):
+			# (we read through the marker even after an error, so the server
+			# can finish its reply)
+			if (error != None): exit("%s: %s" % (programName,error))
+			return
+		if (line.startswith("##error ")):
+			error = line[len("##error "):].rstrip()
+		elif (error == None):
+			out.write(line)
+	exit("%s: the server closed the connection" % programName)
+
+
+# write_warning--
+#	Write a warning line to err. The line goes out in one write, under a lock,
+#	so that warnings from concurrent server threads don't interleave.
+
+warningLock = Lock()
+
+def write_warning(err,message):
+	with warningLock:
+		err.write(message+"\n")
+
+
+# part_intervals--
+#	Yield the genomic interval of each part of a parsed motif, in the order
+#	stem1, loop1, stem2, ..., stemN, tail, as (start,end,kind,num,seq) tuples;
+#	num is None for the tail. The sequence is the part's slice of the motif's
+#	sequence (for "-", that is the reverse complement of the part's text), or
+#	None if withSeq is false.
+
+def part_intervals(g4,strand,parts,withSeq=True):
+	numStems = len(parts.stem)
+	texts = []
+	for stemIx in xrange(numStems):
+		texts += [("stem",1+stemIx,parts.stem[stemIx])]
+		if (stemIx < numStems-1):
+			texts += [("loop",1+stemIx,parts.loop[stemIx])]
+	if (parts.tail != None):
+		texts += [("tail",None,parts.tail)]
+
+	if (strand == "+"):
+		partStart = g4.start
+		for (kind,num,text) in texts:
+			partEnd = partStart + len(text)
+			yield (partStart,partEnd,kind,num,text if (withSeq) else None)
+			partStart = partEnd
+		assert (partEnd == g4.end)
+
+	else: # if (strand == "-"):
+		partEnd = g4.end
+		seq = g4.motifSeq if (withSeq) else None
+		for (kind,num,text) in texts:
+			partStart = partEnd - len(text)
+			yield (partStart,partEnd,kind,num,
+			       seq[partStart-g4.start:partEnd-g4.start] if (withSeq) else None)
+			partEnd = partStart
+		assert (partStart == g4.start)
+
+
+# write_motif_parts--
+#	Sub-annotate a non-g-quadruplex motif with its grammar, and write the
+#	(non-empty) parts. These motifs are symmetric enough that we parse the
+#	sequence as given, on either strand.
+
+def write_motif_parts(motif,matcher,copyInputLines=False,out=None,err=None):
+	if (out == None): out = stdout
+	if (err == None): err = stderr
+
+	if (copyInputLines):
+		print >>out, "# %s" % motif.line
+
+	found = matcher.match(motif.motifSeq)
+	if (found == None):
+		if (copyInputLines): print >>out, "# (unable to sub-annotate)"
+		else:                print >>out, "# unable to sub-annotate %s" % motif.line
+		write_warning(err,"WARNING: unable to sub-annotate %s %d %d: %s" \
+		                % (motif.chrom,motif.start,motif.end,motif.motifSeq))
+		return
+
+	(_,texts) = found
+	strand = "+" if (motif.strand == None) else motif.strand
+	partStart = motif.start
+	for (label,text) in zip(matcher.grammar.labels,texts):
+		partEnd = partStart + len(text)
+		if (text != ""):
+			print >>out, "%s\t%d\t%d\t%s\t%d\t%s\t%s" \
+			           % (motif.chrom,partStart,partEnd,text,len(text),strand,label)
+		partStart = partEnd
+
+
+# g-quadruplex patterns--
+#	Regular expression fragments for the parts of a g-quadruplex motif. These
+#	are assembled into full patterns by the grammars below.
 #
 # Shoutout to
 #	https://docs.python.org/3/howto/regex.html#greedy-versus-non-greedy
@@ -292,229 +920,777 @@ reLoop       = reNt+"{0,6}"+reNonG  # this used to be reNt+"{1,7}"
 reLongLoop   = reNt+"{0,}"+reNonG   # this used to be reNt+"{1,}"
 reTail       = reNt+"*"
 
+gRunFinder   = re_compile("[Gg]+")
+cRunFinder   = re_compile("[Cc]+")
 
-gQuad43Full \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<loop1>"+reLoop+")"
-               + "(?P<stem2>"+reStem+")(?P<loop2>"+reLoop+")"
-               + "(?P<stem3>"+reStem+")(?P<loop3>"+reLoop+")"
-               + "(?P<stem4>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad43BulgesFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<loop1>"+reLoop+")"
-               + "(?P<stem2>"+reBulgedStem+")(?P<loop2>"+reLoop+")"
-               + "(?P<stem3>"+reBulgedStem+")(?P<loop3>"+reLoop+")"
-               + "(?P<stem4>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad43LongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem2>"+reStem+")(?P<loop2>"+reLongLoop+")"
-               + "(?P<stem3>"+reStem+")(?P<loop3>"+reLongLoop+")"
-               + "(?P<stem4>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad43BulgesLongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem2>"+reBulgedStem+")(?P<loop2>"+reLongLoop+")"
-               + "(?P<stem3>"+reBulgedStem+")(?P<loop3>"+reLongLoop+")"
-               + "(?P<stem4>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad32Full \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<loop1>"+reLoop+")"
-               + "(?P<stem2>"+reStem+")(?P<loop2>"+reLoop+")"
-               + "(?P<stem3>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad32BulgesFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<loop1>"+reLoop+")"
-               + "(?P<stem2>"+reBulgedStem+")(?P<loop2>"+reLoop+")"
-               + "(?P<stem3>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad32LongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem2>"+reStem+")(?P<loop2>"+reLongLoop+")"
-               + "(?P<stem3>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad32BulgesLongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem2>"+reBulgedStem+")(?P<loop2>"+reLongLoop+")"
-               + "(?P<stem3>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad21Full \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<loop1>"+reLoop+")"
-               + "(?P<stem2>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad21BulgesFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<loop1>"+reLoop+")"
-               + "(?P<stem2>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad21LongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem2>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad21BulgesLongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem2>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad10Full \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad10BulgesFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad10LongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-gQuad10BulgesLongLoopFull \
-    = re_compile("^"
-               + "(?P<stem1>"+reBulgedStem+")(?P<tail>" +reTail+")"
-               + "$")
-
-loopStemLongLoopFull \
-    = re_compile("^"
-               + "(?P<loop1>"+reLoop+")"
-               + "(?P<stem1>"+reStem+")"
-               + "(?P<loop2>"+reLongLoop+")"
-               + "$")
-
-loopStemLongLoopBulgesFull \
-    = re_compile("^"
-               + "(?P<loop1>"+reLoop+")"
-               + "(?P<stem1>"+reBulgedStem+")"
-               + "(?P<loop2>"+reLongLoop+")"
-               + "$")
-
-longLoopStemLongLoopFull \
-    = re_compile("^"
-               + "(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem1>"+reStem+")"
-               + "(?P<loop2>"+reLongLoop+")"
-               + "$")
-
-longLoopStemLongLoopBulgesFull \
-    = re_compile("^"
-               + "(?P<loop1>"+reLongLoop+")"
-               + "(?P<stem1>"+reBulgedStem+")"
-               + "(?P<loop2>"+reLongLoop+")"
-               + "$")
-
-
-loopAndStemShortest \
-    = re_compile("^(?P<loop>"+reLoop+"?)(?P<stem>"+reStem+"?)")
-
-loopAndStemBulgesShortest \
-    = re_compile("^(?P<loop>"+reLoop+"?)(?P<stem>"+reBulgedStem+"?)")
-
-loopAndStemLongLoopShortest \
-    = re_compile("^(?P<loop>"+reLongLoop+"?)(?P<stem>"+reStem+"?)")
-
-loopAndStemBulgesLongLoopShortest \
-    = re_compile("^(?P<loop>"+reLongLoop+"?)(?P<stem>"+reBulgedStem+"?)")
-
-
-stemLongest \
-    = re_compile("^(?P<stem>"+reStem+")")
-
-stemBulgesLongest \
-    = re_compile("^(?P<stem>"+reBulgedStem+")")
-
-
-class GQuadParts: pass
-
-def parse_as_g_quad(seq):
-
-	# try to parse it with preference for exactly four stems
 
-	parts = parse_as_g_quad_4_stems(seq)
-	if (allowGLoops):
-		if (parts == None):
-			parts = parse_as_g_quad_3_stems(seq)
+# MotifGrammar--
+#	A declarative description of how a motif breaks into named parts.
+#
+# A grammar is a list of parts, each a (label,template) pair, and an ordered
+# list of variants. A template is a regular expression in which %(name)s
+# placeholders are filled from the grammar's symbols; each variant is a
+# (flags,overrides) pair that replaces some of those symbols. A match is
+# attempted with each variant in turn, and the first that matches wins; its
+# flags (e.g. "hasBulge") are reported along with the text of each part.
+#
+# A template can instead be a relation to an earlier part, one of
+# ("same",label), ("mirror",label) or ("inverted",label). Regular expressions
+# can't express mirror or inverted relations, so variants using them are
+# matched procedurally. For now such a variant must have exactly three parts,
+# arm-spacer-arm, with the last related to the first; the longest arm that
+# satisfies the relation is preferred.
+#
+# compile() returns a MotifMatcher. By default, consecutive regex variants
+# are combined into a single alternation, so a match takes one pass through
+# the regex engine regardless of how many variants fail first. Since python's
+# alternation tries its branches in order, this gives exactly the same
+# results as trying each variant's pattern separately, which is what
+# compile(combined=False) does.
+
+class MotifGrammar:
+	def __init__(self,name,parts,symbols=None,variants=None,anchorEnd=True):
+		self.name      = name
+		self.parts     = list(parts)
+		self.labels    = [label for (label,_) in self.parts]
+		self.symbols   = {} if (symbols == None) else dict(symbols)
+		self.variants  = [((),{})] if (variants == None) else list(variants)
+		self.anchorEnd = anchorEnd
+
+		for (label,template) in self.parts:
+			if (type(template) != tuple): continue
+			(relation,other) = template
+			if (relation not in motifRelations):
+				raise ValueError("%s grammar: unknown relation \"%s\"" % (name,relation))
+			if (len(self.parts) != 3) or (label != self.labels[2]) or (other != self.labels[0]):
+				raise ValueError("%s grammar: a relation must be arm-spacer-arm" % name)
+			if (not anchorEnd):
+				raise ValueError("%s grammar: a relation requires anchorEnd" % name)
+
+	def part_patterns(self,overrides):
+		symbols = dict(self.symbols)
+		symbols.update(overrides)
+		patterns = []
+		for (label,template) in self.parts:
+			if (type(template) == tuple): patterns += [template]
+			else:                         patterns += [template % symbols]
+		return patterns
+
+	def compile(self,include=None,combined=True):
+		variants = [(flags,overrides) for (flags,overrides) in self.variants
+		            if (include == None) or (include(flags))]
+		return MotifMatcher(self,variants,combined)
+
+	# complemented--
+	#	Return a copy of this grammar with every nucleotide class complemented.
+	#	Applied to the reverse (not reverse complement) of a sequence, the copy
+	#	matches wherever the original matches the reverse complement, with the
+	#	same flags and part lengths, and with each part's text complemented.
+
+	def complemented(self):
+		parts = []
+		for (label,template) in self.parts:
+			if (type(template) != tuple): template = complement_pattern(template)
+			parts += [(label,template)]
+		symbols  = dict((name,complement_pattern(p)) for (name,p) in self.symbols.items())
+		variants = [(flags,dict((name,complement_pattern(p)) for (name,p) in overrides.items()))
+		            for (flags,overrides) in self.variants]
+		return MotifGrammar(self.name+" (complemented)",parts,symbols,variants,self.anchorEnd)
+
+
+# complement_pattern--
+#	Complement the nucleotides in a regular expression's character classes
+#	(e.g. "[Gg]{3,}" becomes "[Cc]{3,}"); nothing outside of classes changes.
+
+charClassFinder = re_compile(r"\[[^\]]*\]")
+classComplement = maketrans("ACGTacgt","TGCAtgca")
+
+def complement_pattern(pattern):
+	return charClassFinder.sub(lambda m: m.group(0).translate(classComplement),pattern)
+
+
+# MotifMatcher--
+#	A compiled MotifGrammar.
+#
+# match(seq,pos) tries to match the grammar starting at seq[pos], returning
+# None or a (flags,texts) pair, texts being the part texts in grammar order.
+
+class MotifMatcher:
+	def __init__(self,grammar,variants,combined=True):
+		self.grammar = grammar
+		self.stages  = []   # list of (kind,regex,info)
+		pending = []
+		for (flags,overrides) in variants:
+			patterns = grammar.part_patterns(overrides)
+			if (any(type(p) == tuple for p in patterns)):
+				self.flush_regex(pending)
+				pending = []
+				self.stages += [self.relation_stage(flags,patterns)]
+			elif (combined):
+				pending += [(flags,patterns)]
+			else:
+				self.flush_regex([(flags,patterns)])
+		self.flush_regex(pending)
+
+		# a matcher that is a single combined regex (the usual case for the fast
+		# engine) exposes it, so that hot paths can call it directly; see
+		# match() for how its groups are decoded
+
+		self.regex    = None
+		self.byLastIx = None
+		if (len(self.stages) == 1) and (self.stages[0][0] == "combined"):
+			(_,self.regex,self.byLastIx) = self.stages[0]
+
+	def flush_regex(self,variants):
+		if (variants == []): return
+		tail = "$" if (self.grammar.anchorEnd) else ""
+
+		if (len(variants) == 1):
+			(flags,patterns) = variants[0]
+			regex = "".join(["(?P<%s>%s)" % (label,p)
+			                 for (label,p) in zip(self.grammar.labels,patterns)])
+			self.stages += [("single",re_compile(regex+tail),(flags,tuple(self.grammar.labels)))]
+			return
+
+		# each variant is wrapped in an outer group; that group closes last, so
+		# m.lastindex tells us which variant matched
+
+		branches   = []
+		byLastIx   = {}
+		groupCount = 0
+		for (flags,patterns) in variants:
+			groupCount += 1
+			wrapperIx = groupCount
+			partIxs   = []
+			branch    = []
+			for p in patterns:
+				groupCount += 1
+				partIxs += [groupCount]
+				branch  += ["(" + p + ")"]
+				groupCount += re_compile(p).groups
+			branches += ["(" + "".join(branch) + ")"]
+			byLastIx[wrapperIx] = (flags,tuple(partIxs))
+		regex = "(?:" + "|".join(branches) + ")"
+		self.stages += [("combined",re_compile(regex+tail),byLastIx)]
+
+	def relation_stage(self,flags,patterns):
+		(armPattern,spacerPattern,(relation,_)) = patterns
+		armRe    = re_compile("(?:" + armPattern    + ")$")
+		spacerRe = re_compile("(?:" + spacerPattern + ")$")
+		return ("relation",None,(flags,armRe,spacerRe,motifRelations[relation]))
+
+	def match(self,seq,pos=0):
+		if (self.regex != None):
+			m = self.regex.match(seq,pos)
+			if (m == None): return None
+			(flags,partIxs) = self.byLastIx[m.lastindex]
+			return (flags,m.group(*partIxs) if (len(partIxs) > 1) else (m.group(partIxs[0]),))
+
+		for (kind,regex,info) in self.stages:
+			if (kind == "single"):
+				m = regex.match(seq,pos)
+				if (m == None): continue
+				(flags,labels) = info
+				return (flags,m.group(*labels) if (len(labels) > 1) else (m.group(labels[0]),))
+			elif (kind == "combined"):
+				m = regex.match(seq,pos)
+				if (m == None): continue
+				(flags,partIxs) = info[m.lastindex]
+				return (flags,m.group(*partIxs) if (len(partIxs) > 1) else (m.group(partIxs[0]),))
+			else: # if (kind == "relation"):
+				found = match_relation(seq[pos:],info)
+				if (found != None): return found
+		return None
+
+
+def match_relation(seq,info):
+	(flags,armRe,spacerRe,related) = info
+	seqLen = len(seq)
+	for armLen in xrange(seqLen//2,0,-1):
+		arm1 = seq[:armLen]
+		arm2 = seq[seqLen-armLen:]
+		if (not related(arm1.upper(),arm2.upper())): continue
+		spacer = seq[armLen:seqLen-armLen]
+		if (armRe.match(arm1) == None): continue
+		if (spacerRe.match(spacer) == None): continue
+		return (flags,(arm1,spacer,arm2))
+	return None
+
+
+motifRelations = {"same"     : lambda arm1,arm2: arm1 == arm2,
+                  "mirror"   : lambda arm1,arm2: arm1 == arm2[::-1],
+                  "inverted" : lambda arm1,arm2: arm1 == reverse_complement(arm2)}
+
+
+# g-quadruplex grammars--
+#	The stem/loop/tail grammars used by GQuadParser. Every grammar shares the
+#	same four variants, which are tried in this order: plain stems and short
+#	loops, long loops, bulged stems, and bulged stems with long loops.
+
+gQuadSymbols  = {"stem":reStem, "loop":reLoop, "longLoop":reLongLoop, "tail":reTail}
+gQuadVariants = [((),                         {}),
+                 (("hasLongLoop",),           {"loop":reLongLoop}),
+                 (("hasBulge",),              {"stem":reBulgedStem}),
+                 (("hasLongLoop","hasBulge"), {"loop":reLongLoop,"stem":reBulgedStem})]
+
+def g_quad_stems_grammar(name,numStems):
+	parts = []
+	for stemNum in xrange(1,numStems+1):
+		parts += [("stem%d" % stemNum,"%(stem)s")]
+		if (stemNum < numStems): parts += [("loop%d" % stemNum,"%(loop)s")]
+	parts += [("tail","%(tail)s")]
+	return MotifGrammar("g4 "+name,parts,gQuadSymbols,gQuadVariants)
+
+gQuadGrammars = {}
+gQuadGrammars["4 stems"] = g_quad_stems_grammar("4 stems",4)
+gQuadGrammars["3 stems"] = g_quad_stems_grammar("3 stems",3)
+gQuadGrammars["2 stems"] = g_quad_stems_grammar("2 stems",2)
+gQuadGrammars["1 stem"]  = g_quad_stems_grammar("1 stem", 1)
+
+gQuadGrammars["loop-stem-loop"] \
+    = MotifGrammar("g4 loop-stem-loop",
+                   [("loop1","%(loop)s"),("stem1","%(stem)s"),("loop2","%(longLoop)s")],
+                   gQuadSymbols,gQuadVariants)
+
+gQuadGrammars["loop-stem shortest"] \
+    = MotifGrammar("g4 loop-stem shortest",
+                   [("loop","%(loop)s?"),("stem","%(stem)s?")],
+                   gQuadSymbols,gQuadVariants,anchorEnd=False)
+
+gQuadGrammars["stem longest"] \
+    = MotifGrammar("g4 stem longest",
+                   [("stem","%(stem)s")],
+                   gQuadSymbols,gQuadVariants,anchorEnd=False)
+
+# the same grammars for C-runs, used to parse minus-strand motifs in place (see
+# GQuadParser.parse_minus)
+
+cQuadGrammars = dict((name,g.complemented()) for (name,g) in gQuadGrammars.items())
+
+
+# non-B DNA grammars--
+#	Grammars for sub-annotating other non-B DNA motifs, selected with
+#	--motif=<name>. The length limits follow those used for non-B DB.
+
+motifGrammars = {}
+
+motifGrammars["direct"] \
+    = MotifGrammar("direct repeat",
+                   [("arm1",reNt+"{10,300}"),("spacer",reNt+"{0,100}"),("arm2",("same","arm1"))])
+
+motifGrammars["mirror"] \
+    = MotifGrammar("mirror repeat",
+                   [("arm1",reNt+"{10,100}"),("spacer",reNt+"{0,100}"),("arm2",("mirror","arm1"))])
+
+motifGrammars["inverted"] \
+    = MotifGrammar("inverted repeat",
+                   [("arm1",reNt+"{6,100}"),("spacer",reNt+"{0,100}"),("arm2",("inverted","arm1"))])
+
+motifGrammars["z"] \
+    = MotifGrammar("Z-DNA",
+                   [("lead",  reNt+"*?"),
+                    ("tract", "(?:[AGag][CTct]){5,}[AGag]?|(?:[CTct][AGag]){5,}[CTct]?"),
+                    ("trail", reNt+"*")])
+
+
+# GQuadParser--
+#	Parse g-quadruplex motifs into stems, loops and tails.
+#
+# The parsing options are fixed when the parser is constructed, and each
+# parser holds its own compiled grammars. Apart from its optional parse cache,
+# which is guarded by a lock, a parser is never modified after construction,
+# so a single instance can be shared by several threads.
+#
+# With cacheSize > 0, the results of the most recently used sequences are
+# kept, so a repeated sequence is parsed only once; cache_stats() reports the
+# hits and misses.
+#
+# The engine is either "fast", which matches each grammar with a single
+# combined pattern, or "regex", which tries each variant's pattern in turn;
+# the latter is the reference behavior the fast engine must reproduce.
+#
+# The regex engine parses a minus-strand motif by reverse complementing it.
+# The fast engine instead reverses it (without complementing) and parses that
+# with the C-run grammars. The stems, loops and tail it finds have the same
+# lengths, but their texts are complements of those on the g-rich strand;
+# such parts are marked as mirrored. parse_record() complements them back, so
+# both engines return the same parts, unless the caller asks for mirrored
+# parts with allowMirrored (as MotifAnnotator does). part_intervals() takes
+# the sequence of each part from the motif itself, so it gives the same
+# output either way.
+#
+# Typical use from python:
+#	parser = GQuadParser(allowBulges=True)
+#	parts  = parser.parse("GGGCGGGGGTTGGGGGGG")
+#	for (g4,parts) in parser.parse_many(read_gquad_bed(f)):
+#		...
+
+class GQuadParts:
+	mirrored = False   # true if the texts are complements of the g-rich strand
+
+class MirroredGQuadParts(GQuadParts):
+	mirrored = True
+
+gQuadEngines = ["fast","regex"]   # "regex" is the reference behavior
+
+class GQuadParser:
+	def __init__(self,allowBulges=False,allowGLoops=True,
+	             parseAs="latest version",engine="fast",cacheSize=0,debug=None):
+		if (parseAs not in ["latest version","4 stems"]):
+			raise ValueError("unknown parse preference: \"%s\"" % parseAs)
+		if (engine not in gQuadEngines):
+			raise ValueError("unknown parse engine: \"%s\"" % engine)
+
+		self.allowBulges = allowBulges
+		self.allowGLoops = allowGLoops
+		self.parseAs     = parseAs
+		self.engine      = engine
+		self.debug       = [] if (debug == None) else list(debug)
+
+		self.compile_grammars(gQuadGrammars)
+		self.stemNuc    = "G"
+		self.stemNucs   = "Gg"
+		self.runFinder  = gRunFinder
+		self.partsClass = GQuadParts
+
+		self.cacheSize   = cacheSize
+		self.cache       = None
+		self.cacheHits   = 0
+		self.cacheMisses = 0
+		if (cacheSize > 0):
+			self.cache     = OrderedDict()
+			self.cacheLock = Lock()
+
+		self.mirror = None
+		if (engine == "fast"):
+			self.mirror = self.mirrored_parser()
+		self.bind_entry_points()
+
+	def compile_grammars(self,grammars):
+		allowBulges = self.allowBulges
+		include  = lambda flags: (allowBulges) or ("hasBulge" not in flags)
+		combined = (self.engine == "fast")
+		grammar  = dict((name,g.compile(include,combined)) for (name,g) in grammars.items())
+		self.gQuad4Stems         = grammar["4 stems"]
+		self.gQuad3Stems         = grammar["3 stems"]
+		self.gQuad2Stems         = grammar["2 stems"]
+		self.gQuad1Stem          = grammar["1 stem"]
+		self.loopStemLoop        = grammar["loop-stem-loop"]
+		self.loopAndStemShortest = grammar["loop-stem shortest"]
+		self.stemLongest         = grammar["stem longest"]
+
+		# the stems grammars parse_fast tries, in order, as (regex,byLastIx)
+		# pairs; None if the fast path can't be used
+
+		if (self.parseAs == "4 stems") or (not self.allowGLoops):
+			cascade = [self.gQuad4Stems]
+		else:
+			cascade = [self.gQuad4Stems,self.gQuad3Stems,self.gQuad2Stems,self.gQuad1Stem]
+		self.stemsCascade = None
+		if (self.engine == "fast") and (self.debug == []) \
+		   and (all(g.regex != None for g in cascade)):
+			self.stemsCascade = [(g.regex,g.byLastIx) for g in cascade]
+
+	# bind_entry_points--
+	#	Choose the functions parse_record uses for each strand. Without a cache
+	#	these go straight to the parse, skipping the parse() and parse_minus()
+	#	layers, since per-record call overhead is a large part of the cost of
+	#	parsing a typical short motif.
+
+	def bind_entry_points(self):
+		if (self.cache != None):
+			self.parsePlus  = self.parse
+			self.parseMinus = self.parse_minus
+			return
+
+		direct = self.parse_fast if (self.stemsCascade != None) else self.parse_uncached
+		self.parsePlus = direct
+		if (self.mirror != None):
+			mirror = self.mirror
+			mirrorDirect = mirror.parse_fast if (mirror.stemsCascade != None) else mirror.parse_uncached
+			self.parseMinus = lambda seq: mirrorDirect(seq[::-1])
+		else:
+			self.parseMinus = lambda seq: direct(reverse_complement(seq))
+
+	# mirrored_parser--
+	#	Return a copy of this parser that parses reversed minus-strand motifs
+	#	with the C-run grammars. It has no cache of its own; parse() caches its
+	#	results along with ours.
+
+	def mirrored_parser(self):
+		mirror = copy(self)
+		mirror.compile_grammars(cQuadGrammars)
+		mirror.stemNuc    = "C"
+		mirror.stemNucs   = "Cc"
+		mirror.runFinder  = cRunFinder
+		mirror.partsClass = MirroredGQuadParts
+		mirror.cache      = None
+		mirror.mirror     = None
+		mirror.bind_entry_points()
+		return mirror
+
+	# parse--
+	#	Parse a sequence (as given, i.e. on the g-rich strand), returning an
+	#	object describing its parts, or None. If mirrored is true, the sequence
+	#	is instead the reverse of a c-rich motif, and is parsed with the C-run
+	#	grammars.
+
+	def parse(self,seq,mirrored=False):
+		parseUncached = self.parse_uncached
+		key = seq
+		if (mirrored):
+			parseUncached = self.mirror.parse_uncached
+			key = ("mirrored",seq)
+
+		if (self.cache == None):
+			return parseUncached(seq)
+
+		# the cache holds immutable copies of the results, so that callers are
+		# free to modify the parts objects we return
+
+		with self.cacheLock:
+			frozen = self.cache.pop(key,None)
+			if (frozen != None):
+				self.cache[key] = frozen   # (move it to most recently used)
+				self.cacheHits += 1
+			else:
+				self.cacheMisses += 1
+
+		if (frozen != None):
+			if (frozen == False): return None
+			(stems,loops,tail,hasLongLoop,hasBulge) = frozen
+			parts = MirroredGQuadParts() if (mirrored) else GQuadParts()
+			parts.stem        = list(stems)
+			parts.loop        = list(loops)
+			parts.tail        = tail
+			parts.hasLongLoop = hasLongLoop
+			parts.hasBulge    = hasBulge
+			return parts
+
+		parts = parseUncached(seq)
 		if (parts == None):
-			parts = parse_as_g_quad_2_stems(seq)
+			frozen = False
+		else:
+			frozen = (tuple(parts.stem),tuple(parts.loop),parts.tail,
+			          parts.hasLongLoop,parts.hasBulge)
+
+		with self.cacheLock:
+			self.cache[key] = frozen
+			if (len(self.cache) > self.cacheSize):
+				self.cache.popitem(last=False)
+
+		return parts
+
+	def parse_uncached(self,seq):
+		if (self.stemsCascade != None): return self.parse_fast(seq)
+		if (self.parseAs == "4 stems"): return self.parse_as_g_quad_4_stems(seq)
+		else:                           return self.parse_as_g_quad(seq)
+
+	# parse_minus--
+	#	Parse a motif given on the minus strand; see the notes on engines above.
+
+	def parse_minus(self,seq):
+		if (self.mirror == None): return self.parse(reverse_complement(seq))
+		else:                     return self.parse(seq[::-1],mirrored=True)
+
+	def cache_stats(self):
+		return (self.cacheHits,self.cacheMisses)
+
+	# parse_record--
+	#	Parse one motif record. If strand is "-" the sequence is parsed as the
+	#	g-rich reverse complement; if strand is None we try the sequence as
+	#	given and then as the reverse complement. The parts object returned has
+	#	chrom, start, end, and strand (the strand that parsed) filled in; the
+	#	parts themselves are on that strand. None is returned if the motif
+	#	can't be parsed.
+	#
+	#	If allowMirrored is true, minus-strand parts may be returned with their
+	#	texts complemented (see parts.mirrored), which saves the work of
+	#	complementing them when only their lengths are needed.
+
+	def parse_record(self,chrom,start,end,seq,strand=None,allowMirrored=False):
+		if (strand == "+"):
+			parts = self.parsePlus(seq)
+		elif (strand == "-"):
+			parts = self.parseMinus(seq)
+		elif (strand == None):
+			strand = "+"
+			parts = self.parsePlus(seq)
+			if (parts == None):
+				strand = "-"
+				parts = self.parseMinus(seq)
+		else:
+			raise ValueError("strand is not + nor -: \"%s\"" % strand)
+
+		if (parts == None): return None
+		if (parts.mirrored) and (not allowMirrored):
+			parts.stem = map(complement,parts.stem)
+			parts.loop = map(complement,parts.loop)
+			if (parts.tail != None): parts.tail = complement(parts.tail)
+			parts.mirrored = False
+		parts.chrom  = chrom
+		parts.start  = start
+		parts.end    = end
+		parts.strand = strand
+		return parts
+
+	# parse_many--
+	#	Parse a series of motif records, yielding (record,parts) pairs in the
+	#	same order. A record is either an object like those yielded by
+	#	read_gquad_bed, or a (chrom,start,end,seq[,strand]) tuple.
+
+	def parse_many(self,records):
+		for record in records:
+			if (type(record) in [tuple,list]):
+				(chrom,start,end,seq) = record[:4]
+				strand = record[4] if (len(record) > 4) else None
+			else:
+				(chrom,start,end,seq) = (record.chrom,record.start,record.end,record.motifSeq)
+				strand = record.strand
+			yield (record,self.parse_record(chrom,start,end,seq,strand))
+
+	# parse_as_g_quad--
+	#	Try to parse a sequence, in its entirety, as a g-qudruplex motif.  If
+	#	succesful, return an object describing the parts of the motif.
+	#	Otherwise, return None.
+
+	def parse_as_g_quad(self,seq):
+
+		# try to parse it with preference for exactly four stems
+
+		parts = self.parse_as_g_quad_4_stems(seq)
+		if (self.allowGLoops):
+			if (parts == None):
+				parts = self.parse_as_g_quad_3_stems(seq)
+			if (parts == None):
+				parts = self.parse_as_g_quad_2_stems(seq)
+			if (parts == None):
+				parts = self.parse_as_g_quad_1_stem(seq)
+
 		if (parts == None):
-			parts = parse_as_g_quad_1_stem(seq)
+			return None
 
-	if (parts == None):
-		return None
+		# try to re-parse each loop into a loop-stem-loop
+		#
+		# note that we can change an original loop into a series of
+		# loop-stem-loop-...-stem-loop of any length; each original loop is
+		# split independently, and its pieces take its place
 
-	# try to re-parse each loop into a loop-stem-loop
+		if (self.engine == "fast"): splitLoop = self.split_loop_by_runs
+		else:                       splitLoop = self.split_loop_by_regex
+
+		stems = [parts.stem[0]]
+		loops = []
+		for (ix,loop) in enumerate(parts.loop):
+			pieces = splitLoop(parts,loop)
+			loops += pieces[0::2]
+			stems += pieces[1::2]
+			stems += [parts.stem[ix+1]]
+		parts.stem = stems
+		parts.loop = loops
+
+		# if we don't have at least four stems, try to split stems into stem-G-stem,
+		# using the middle G as a loop
+
+		if (self.allowGLoops) and (len(parts.stem) < 4):
+			if (self.engine == "fast"): self.split_stems_one_pass(parts)
+			else:                       self.split_stems_in_place(parts)
+
+		# if we still don't have at least four stems, give up
+
+		if (len(parts.stem) < 4):
+			return None
+
+		# check whether the result has any long loops; it might have originally
+		# had some, but they could have been shortened to loop-stem-loop
+
+		parts.hasLongLoop = False
+		for loop in parts.loop:
+			if (len(loop) > 7):
+				parts.hasLongLoop = True
+				break
+
+		return parts
+
+
+
+	# parse_fast--
+	#	The fast engine's equivalent of parse_as_g_quad (or, with
+	#	parseAs="4 stems", of parse_as_g_quad_4_stems), with the stems
+	#	grammars' regexes called directly. Loops too short to split are left
+	#	alone, so the stem and loop lists are only rebuilt when some loop
+	#	actually splits.
+
+	def parse_fast(self,seq):
+		for (regex,byLastIx) in self.stemsCascade:
+			m = regex.match(seq)
+			if (m != None): break
+		else:
+			return None
+
+		(flags,partIxs) = byLastIx[m.lastindex]
+		texts = m.group(*partIxs)
+		parts = self.partsClass()
+		parts.hasLongLoop = ("hasLongLoop" in flags)
+		parts.hasBulge    = ("hasBulge"    in flags)
+		parts.stem = list(texts[0:-1:2])
+		parts.loop = list(texts[1:-1:2])
+		leftover   = texts[-1]
+		if (leftover != ""):
+			leftover = self.reparse_leftover(parts,leftover)
+		parts.tail = None if (leftover == "") else leftover
+
+		if (self.parseAs == "4 stems"):
+			return parts
+
+		# re-parse loops into loop-stem-loop (see split_loop_by_runs)
+
+		stems    = parts.stem
+		loops    = parts.loop
+		stemNucs = self.stemNucs
+		splits   = None
+		for (ix,loop) in enumerate(loops):
+			if (len(loop) < 5) or (loop[-1] in stemNucs): continue
+			pieces = self.split_loop_by_runs(parts,loop)
+			if (len(pieces) == 1): continue
+			if (splits == None): splits = {}
+			splits[ix] = pieces
+
+		if (splits != None):
+			newStems = [stems[0]]
+			newLoops = []
+			for (ix,loop) in enumerate(loops):
+				pieces = splits.get(ix)
+				if (pieces == None):
+					newLoops += [loop]
+				else:
+					newLoops += pieces[0::2]
+					newStems += pieces[1::2]
+				newStems += [stems[ix+1]]
+			parts.stem = stems = newStems
+			parts.loop = loops = newLoops
+
+		if (len(stems) < 4):
+			if (self.allowGLoops): self.split_stems_one_pass(parts)
+			if (len(parts.stem) < 4): return None
+			loops = parts.loop
+
+		parts.hasLongLoop = (max(map(len,loops)) > 7)
+		return parts
+
+	# split_loop_by_regex--
+	#	Re-parse a loop into a series of loop-stem-...-stem-loop, returning
+	#	the list of pieces (alternating loop and stem). This is the reference
+	#	implementation; it matches the loop-stem-loop grammar against each
+	#	loop, and then again against each of the resulting loops.
 	#
-	# note that we don't use the typical "for ix in xrange(parts.loop)" loop
-	# because we are potentially modifying the lists as we go
+	# Note that we don't use the typical "for ix in xrange(loops)" loop because
+	# we are potentially modifying the lists as we go. This sorta happens right
+	# to left, since the regex finds the rightmost stem.
+
+	def split_loop_by_regex(self,parts,loop):
+		loops = [loop]
+		stems = []
+
+		ix = 0
+		while (ix < len(loops)):
+			loop = loops[ix]
+
+			found = self.loopStemLoop.match(loop)
+
+			if (found != None):
+				(flags,(loop1,stem1,loop2)) = found
+				if ("hasBulge" in flags): parts.hasBulge = True
+
+				if ("loop-stem-loop" in self.debug):
+					print >>stderr, "%s becomes %s/%s/%s" \
+					              % (loop,loop1,stem1,loop2)
+
+				loops[ix] = loop1  # replaces loop
+				stems.insert(ix,stem1)
+				loops.insert(ix+1,loop2)
+				# we *don't* increment ix in this case, because we may still have
+				# a stem embedded in loop1
+
+			else:
+				ix += 1
+
+		pieces = [loops[0]]
+		for ix in xrange(len(stems)):
+			pieces += [stems[ix],loops[ix+1]]
+		return pieces
+
+	# split_loop_by_runs--
+	#	Produce the same pieces as split_loop_by_regex, in a single pass over
+	#	the loop's G-runs.
+	#
+	# The loop-stem-loop grammar requires the loop to end with a non-G. Its
+	# stem must then be a whole run of at least three Gs, not at the start of
+	# the loop. The first variant takes the rightmost such run starting within
+	# the first seven bases; failing that, the second takes the rightmost run
+	# overall. The same rules then apply to the loops on either side, whose
+	# runs are a contiguous sub-range of the original's. So we find the runs
+	# once and walk that structure with an explicit stack, which costs
+	# O(n + r log r) rather than the O(n r) of re-matching.
 	#
-	# also note that we can change an original loop into a series of
-	# loop-stem-loop-...-stem-loop of any length; this sorta happens right to
-	# left, since the regex finds the rightmost stem
-
-	ix = 0
-	while (ix < len(parts.loop)):
-		loop = parts.loop[ix]
-
-		m = loopStemLongLoopFull.match(loop)
-		if (m == None):
-			m = longLoopStemLongLoopFull.match(loop)
-
-		if (allowBulges):
-			if (m == None):
-				m = loopStemLongLoopBulgesFull.match(loop)
-				if (m != None): parts.hasBulge = True
-			if (m == None):
-				m = longLoopStemLongLoopBulgesFull.match(loop)
-				if (m != None): parts.hasBulge = True
+	# Bulged stems are only considered when no plain stem is available, and
+	# then neither side of the split contains a plain stem either. So a piece
+	# with no qualifying runs is handed to split_loop_by_regex when bulges are
+	# allowed.
+
+	def split_loop_by_runs(self,parts,loop):
+		if (len(loop) < 5) or (loop[-1] in self.stemNucs):   # too short for loop-stem-loop
+			return [loop]
+
+		starts = []
+		ends   = []
+		for m in self.runFinder.finditer(loop):
+			if (m.start() == 0) or (m.end()-m.start() < 3): continue
+			starts += [m.start()]
+			ends   += [m.end()]
+
+		if (starts == []) and (not self.allowBulges):
+			return [loop]
+
+		pieces = []
+		stack  = [(0,len(loop),0,len(starts))]
+		while (stack != []):
+			item = stack.pop()
+			if (type(item) == str):
+				pieces += [item]
+				continue
 
-		if (m != None):
-			loop1 = m.group("loop1")
-			stem1 = m.group("stem1")
-			loop2 = m.group("loop2")
+			(lo,hi,runLo,runHi) = item
+			if (runLo == runHi):
+				if (self.allowBulges):
+					pieces += self.split_loop_by_regex(parts,loop[lo:hi])
+				else:
+					pieces += [loop[lo:hi]]
+				continue
 
-			if ("loop-stem-loop" in debug):
+			runIx = bisect_right(starts,lo+7,runLo,runHi) - 1
+			if (runIx < runLo): runIx = runHi - 1
+			(stemStart,stemEnd) = (starts[runIx],ends[runIx])
+
+			if ("loop-stem-loop" in self.debug):
 				print >>stderr, "%s becomes %s/%s/%s" \
-				              % (loop,loop1,stem1,loop2)
+				              % (loop[lo:hi],loop[lo:stemStart],
+				                 loop[stemStart:stemEnd],loop[stemEnd:hi])
 
-			parts.loop[ix] = loop1  # replaces loop
-			parts.stem.insert(ix+1,stem1)
-			parts.loop.insert(ix+1,loop2)
-			# we *don't* increment ix in this case, because we may still have
-			# a stem embedded in loop1
+			stack += [(stemEnd,hi,runIx+1,runHi),
+			          loop[stemStart:stemEnd],
+			          (lo,stemStart,runLo,runIx)]
 
-		else:
-			ix += 1
+		return pieces
 
-	# if we don't have at least four stems, try to split stems into stem-G-stem,
-	# using the middle G as a loop
+	# split_stems_in_place--
+	#	Split all-G stems of at least seven Gs into stem-G-stem, until there
+	#	are four stems. This is the reference implementation.
 	#
-	# note that we don't use the typical "for ix in xrange(parts.stem)" stem
-	# because we are potentially modifying the lists as we go
+	# Note that we don't use the typical "for ix in xrange(parts.stem)" stem
+	# because we are potentially modifying the lists as we go.
 
-
-	if (allowGLoops) and (len(parts.stem) < 4):
+	def split_stems_in_place(self,parts):
 		ix = 0
 		while (ix < len(parts.stem)) and (len(parts.stem) < 4):
 			stem = parts.stem[ix]
@@ -524,7 +1700,7 @@ def parse_as_g_quad(seq):
 
 			isAllGs = True
 			for nuc in stem:
-				if (nuc != "G"):
+				if (nuc != self.stemNuc):
 					isAllGs = False
 					break
 			if (not isAllGs):
@@ -535,329 +1711,462 @@ def parse_as_g_quad(seq):
 			loop1 = stem[3]
 			stem2 = stem[4:]
 
-			if ("stem-loop-stem" in debug):
+			if ("stem-loop-stem" in self.debug):
 				print >>stderr, "%s becomes %s/%s/%s" \
-				              % (loop,stem1,loop1,stem2)
+				              % (stem,stem1,loop1,stem2)
 
 			parts.stem[ix] = stem1  # replaces loop
 			parts.loop.insert(ix  ,loop1)
 			parts.stem.insert(ix+1,stem2)
 			ix += 1
 
-	# if we still don't have at least four stems, give up
-
-	if (len(parts.stem) < 4):
-		return None
-
-	# check whether the result has any long loops; it might have originally
-	# had some, but they could have been shortened to loop-stem-loop
-
-	parts.hasLongLoop = False
-	for loop in parts.loop:
-		if (len(loop) > 7):
-			parts.hasLongLoop = True
-			break
+	# split_stems_one_pass--
+	#	Produce the same split as split_stems_in_place, building new lists in
+	#	one left-to-right pass; a split stem's second half is examined next,
+	#	just as it would be after insertion.
 
-	return parts
-
-
-# parse_as_g_quad_4_stems--
-#	Gives preference to parsing the string into a four-stem object.
-
-def parse_as_g_quad_4_stems(seq):
-	if ("regex" in debug):
-		print >>stderr, "seq = \"%s\"" % seq
-
-	hasLongLoop = hasBulge = False
-	m = gQuad43Full.match(seq)
-
-	if (m == None):
-		m = gQuad43LongLoopFull.match(seq)
-		if (m != None): hasLongLoop = True
+	def split_stems_one_pass(self,parts):
+		numStems = len(parts.stem)
+		stems = []
+		loops = []
+		for (ix,stem) in enumerate(parts.stem):
+			while (numStems < 4) and (len(stem) >= 7) and (stem.strip(self.stemNuc) == ""):
+				stem1 = stem[:3]
+				loop1 = stem[3]
+				stem2 = stem[4:]
 
-	if (allowBulges):
-		if (m == None):
-			m = gQuad43BulgesFull.match(seq)
-			if (m != None): hasBulge = True
-		if (m == None):
-			m = gQuad43BulgesLongLoopFull.match(seq)
-			if (m != None): hasLongLoop = hasBulge = True
+				if ("stem-loop-stem" in self.debug):
+					print >>stderr, "%s becomes %s/%s/%s" \
+					              % (stem,stem1,loop1,stem2)
 
-	if (m == None):     # shouldn't happen, assuming the inputs are really
-		return None     # .. g-quadruplex motifs
+				stems += [stem1]
+				loops += [loop1]
+				stem = stem2
+				numStems += 1
 
-	parts = GQuadParts()
-	parts.hasLongLoop = hasLongLoop
-	parts.hasBulge    = hasBulge
-	parts.stem  = []
-	parts.loop  = []
-	parts.stem += [m.group("stem1")]
-	parts.loop += [m.group("loop1")]
-	parts.stem += [m.group("stem2")]
-	parts.loop += [m.group("loop2")]
-	parts.stem += [m.group("stem3")]
-	parts.loop += [m.group("loop3")]
-	parts.stem += [m.group("stem4")]
-	leftover   =   m.group("tail")
+			stems += [stem]
+			if (ix < len(parts.loop)): loops += [parts.loop[ix]]
+		parts.stem = stems
+		parts.loop = loops
 
-	if ("regex" in debug):
-		print >>stderr, "  stem1: \"%s\"" % parts.stem1
-		print >>stderr, "  loop1: \"%s\"" % parts.loop1
-		print >>stderr, "  stem2: \"%s\"" % parts.stem2
-		print >>stderr, "  loop2: \"%s\"" % parts.loop2
-		print >>stderr, "  stem3: \"%s\"" % parts.stem3
-		print >>stderr, "  loop3: \"%s\"" % parts.loop3
-		print >>stderr, "  stem4: \"%s\"" % parts.stem4
-		print >>stderr, "  tail:  \"%s\"" % leftover
-
-	# if there's any left over, try to re-parse it into more loops and stems
-
-	if (leftover != ""):
-		leftover = reparse_leftover(parts,leftover)
-
-	parts.tail = None if (leftover == "") else leftover
-
-	return parts
-
-
-# parse_as_g_quad_3_stems--
-#	Gives preference to parsing the string into a three-stem object.
-
-def parse_as_g_quad_3_stems(seq):
-	if ("regex" in debug):
-		print >>stderr, "seq = \"%s\"" % seq
+	# parse_as_g_quad_4_stems--
+	#	Gives preference to parsing the string into a four-stem object.
 
-	hasLongLoop = hasBulge = False
-	m = gQuad32Full.match(seq)
+	def parse_as_g_quad_4_stems(self,seq):
+		return self.parse_as_g_quad_n_stems(seq,self.gQuad4Stems)
 
-	if (m == None):
-		m = gQuad32LongLoopFull.match(seq)
-		if (m != None): hasLongLoop = True
+	# parse_as_g_quad_3_stems--
+	#	Gives preference to parsing the string into a three-stem object.
 
-	if (allowBulges):
-		if (m == None):
-			m = gQuad32BulgesFull.match(seq)
-			if (m != None): hasBulge = True
-		if (m == None):
-			m = gQuad32BulgesLongLoopFull.match(seq)
-			if (m != None): hasLongLoop = hasBulge = True
+	def parse_as_g_quad_3_stems(self,seq):
+		return self.parse_as_g_quad_n_stems(seq,self.gQuad3Stems)
 
-	if (m == None):     # shouldn't happen, assuming the inputs are really
-		return None     # .. g-quadruplex motifs
-
-	parts = GQuadParts()
-	parts.hasLongLoop = hasLongLoop
-	parts.hasBulge    = hasBulge
-	parts.stem  = []
-	parts.loop  = []
-	parts.stem += [m.group("stem1")]
-	parts.loop += [m.group("loop1")]
-	parts.stem += [m.group("stem2")]
-	parts.loop += [m.group("loop2")]
-	parts.stem += [m.group("stem3")]
-	leftover   =   m.group("tail")
-
-	if ("regex" in debug):
-		print >>stderr, "  stem1: \"%s\"" % parts.stem1
-		print >>stderr, "  loop1: \"%s\"" % parts.loop1
-		print >>stderr, "  stem2: \"%s\"" % parts.stem2
-		print >>stderr, "  loop2: \"%s\"" % parts.loop2
-		print >>stderr, "  stem3: \"%s\"" % parts.stem3
-		print >>stderr, "  tail:  \"%s\"" % leftover
-
-	# if there's any left over, try to re-parse it into more loops and stems
-
-	if (leftover != ""):
-		leftover = reparse_leftover(parts,leftover)
-
-	parts.tail = None if (leftover == "") else leftover
-
-	return parts
-
-
-# parse_as_g_quad_2_stems--
-#	Gives preference to parsing the string into a two-stem object.
-
-def parse_as_g_quad_2_stems(seq):
-	if ("regex" in debug):
-		print >>stderr, "seq = \"%s\"" % seq
+	# parse_as_g_quad_2_stems--
+	#	Gives preference to parsing the string into a two-stem object.
 
-	hasLongLoop = hasBulge = False
-	m = gQuad21Full.match(seq)
+	def parse_as_g_quad_2_stems(self,seq):
+		return self.parse_as_g_quad_n_stems(seq,self.gQuad2Stems)
 
-	if (m == None):
-		m = gQuad21LongLoopFull.match(seq)
-		if (m != None): hasLongLoop = True
+	# parse_as_g_quad_1_stem--
+	#	Gives preference to parsing the string into a one-stem object.
 
-	if (allowBulges):
-		if (m == None):
-			m = gQuad21BulgesFull.match(seq)
-			if (m != None): hasBulge = True
-		if (m == None):
-			m = gQuad21BulgesLongLoopFull.match(seq)
-			if (m != None): hasLongLoop = hasBulge = True
+	def parse_as_g_quad_1_stem(self,seq):
+		return self.parse_as_g_quad_n_stems(seq,self.gQuad1Stem)
 
-	if (m == None):     # shouldn't happen, assuming the inputs are really
-		return None     # .. g-quadruplex motifs
+	# parse_as_g_quad_n_stems--
+	#	Parse the string with one of the stems grammars, which have the form
+	#	stem1 loop1 ... stemN tail.
 
-	parts = GQuadParts()
-	parts.hasLongLoop = hasLongLoop
-	parts.hasBulge    = hasBulge
-	parts.stem  = []
-	parts.loop  = []
-	parts.stem += [m.group("stem1")]
-	parts.loop += [m.group("loop1")]
-	parts.stem += [m.group("stem2")]
-	leftover   =   m.group("tail")
+	def parse_as_g_quad_n_stems(self,seq,grammar):
+		if ("regex" in self.debug):
+			print >>stderr, "seq = \"%s\"" % seq
 
-	if ("regex" in debug):
-		print >>stderr, "  stem1: \"%s\"" % parts.stem1
-		print >>stderr, "  loop1: \"%s\"" % parts.loop1
-		print >>stderr, "  stem2: \"%s\"" % parts.stem2
-		print >>stderr, "  tail:  \"%s\"" % leftover
+		found = grammar.match(seq)
+		if (found == None): # shouldn't happen, assuming the inputs are really
+			return None     # .. g-quadruplex motifs
 
-	# if there's any left over, try to re-parse it into more loops and stems
+		(flags,texts) = found
+		parts = self.partsClass()
+		parts.hasLongLoop = ("hasLongLoop" in flags)
+		parts.hasBulge    = ("hasBulge"    in flags)
+		parts.stem  = list(texts[0:-1:2])
+		parts.loop  = list(texts[1:-1:2])
+		leftover    = texts[-1]
 
-	if (leftover != ""):
-		leftover = reparse_leftover(parts,leftover)
+		if ("regex" in self.debug):
+			for (label,text) in zip(grammar.grammar.labels,texts):
+				print >>stderr, "  %-6s \"%s\"" % (label+":",text)
 
-	parts.tail = None if (leftover == "") else leftover
+		# if there's any left over, try to re-parse it into more loops and stems
 
-	return parts
+		if (leftover != ""):
+			leftover = self.reparse_leftover(parts,leftover)
 
+		parts.tail = None if (leftover == "") else leftover
 
-# parse_as_g_quad_1_stem--
-#	Gives preference to parsing the string into a one-stem object.
+		return parts
 
-def parse_as_g_quad_1_stem(seq):
-	if ("regex" in debug):
-		print >>stderr, "seq = \"%s\"" % seq
+	# reparse_leftover--
+	#	Try to re-parse a leftover tail into more loops and stems
+	#
+	# Note that this may modify parts.
+
+	def reparse_leftover(self,parts,leftover):
+
+		# as long as there's any left over, try to re-parse it into more loops and
+		# stems
+		#
+		# nota bene: the regular expressions used here are designed to find the
+		#            *shortest* match
+
+		if (self.engine == "fast"):
+			# match at successive positions rather than re-slicing the leftover
+			pos = 0
+			while (pos < len(leftover)):
+				found = self.loopAndStemShortest.match(leftover,pos)
+				if (found == None):
+					break
 
-	hasLongLoop = hasBulge = False
-	m = gQuad10Full.match(seq)
+				(flags,(loop,stem)) = found
+				pos += len(loop)+len(stem)
+				parts.loop += [loop]
+				parts.stem += [stem]
+			leftover = leftover[pos:]
 
-	if (m == None):
-		m = gQuad10LongLoopFull.match(seq)
-		if (m != None): hasLongLoop = True
+		else:
+			while (leftover != ""):
+				found = self.loopAndStemShortest.match(leftover)
+				if (found == None):
+					break
 
-	if (allowBulges):
-		if (m == None):
-			m = gQuad10BulgesFull.match(seq)
-			if (m != None): hasBulge = True
-		if (m == None):
-			m = gQuad10BulgesLongLoopFull.match(seq)
-			if (m != None): hasLongLoop = hasBulge = True
+				(flags,(loop,stem)) = found
+				leftover = leftover[len(loop)+len(stem):]
+				parts.loop += [loop]
+				parts.stem += [stem]
 
-	if (m == None):     # shouldn't happen, assuming the inputs are really
-		return None     # .. g-quadruplex motifs
+		# if there's still any left over, try to re-parse it, in combination with
+		# the final stem, into a longer stem; this is to resolve the issue of the
+		# shortest match use above not including everything it might in the final
+		# stem
 
-	parts = GQuadParts()
-	parts.hasLongLoop = hasLongLoop
-	parts.hasBulge    = hasBulge
-	parts.stem  = []
-	parts.loop  = []
-	parts.stem += [m.group("stem1")]
-	leftover   =   m.group("tail")
+		if (leftover != ""):
+			stemPlusLeftover = parts.stem[-1] + leftover
 
-	if ("regex" in debug):
-		print >>stderr, "  stem1: \"%s\"" % parts.stem1
-		print >>stderr, "  tail:  \"%s\"" % leftover
+			found = self.stemLongest.match(stemPlusLeftover)
 
-	# if there's any left over, try to re-parse it into more loops and stems
+			if (found != None):
+				(flags,(stem,)) = found
+				leftover = stemPlusLeftover[len(stem):]
+				parts.stem[-1] = stem
 
-	if (leftover != ""):
-		leftover = reparse_leftover(parts,leftover)
+		return leftover
 
-	parts.tail = None if (leftover == "") else leftover
 
-	return parts
+# read_gquad_bed--
+#	Yield the next g-quadruplex from a bed file. If allowBadLength is true, a
+#	record whose sequence length doesn't match its interval has its end
+#	adjusted to fit the sequence; otherwise that is an error. firstLine is
+#	the line number (in error messages) of f's first line.
 
+class GQuad: pass
 
-# reparse_leftover--
-#	Try to re-parse a leftover tail into more loops and stems
-#
-# Note that this may modify parts.
+def read_gquad_bed(f,fName=None,firstLine=1,allowBadLength=False):
+	if (fName == None): fName = "input"
 
-def reparse_leftover(parts,leftover):
+	lineNumber = firstLine-1
+	for line in f:
+		lineNumber += 1
+		g4 = gquad_from_line(line,lineNumber,fName,allowBadLength)
+		if (g4 != None): yield g4
 
-	# as long as there's any left over, try to re-parse it into more loops and
-	# stems
-	#
-	# nota bene: the regular expressions used here are designed to find the
-	#            *shortest* match
 
-	while (leftover != ""):
-		m = loopAndStemShortest.match(leftover)
+# gquad_from_line--
+#	Parse and validate one bed line; blank lines and comments give None.
 
-		if (m == None):
-			m = loopAndStemLongLoopShortest.match(leftover)
-			if (m != None): hasLongLoop = True
+def gquad_from_line(line,lineNumber,fName,allowBadLength=False):
+	line = line.strip()
+	if (line == "") or (line.startswith("#")):
+		return None
 
-		if (allowBulges):
-			if (m == None):
-				m = loopAndStemBulgesShortest.match(leftover)
-				if (m != None): hasBulge = True
-			if (m == None):
-				m = loopAndStemBulgesLongLoopShortest.match(leftover)
-				if (m != None): hasLongLoop = hasBulge = True
+	fields = line.split()
+	assert (len(fields) in [4,5,6,7]), \
+	      "wrong number of fields at line %s in %s (got %d expected 4, 5, 6, or 7):\n%s" \
+	    % (lineNumber,fName,len(fields),line)
+
+	try:
+		chrom    =     fields[0]
+		start    = int(fields[1])
+		end      = int(fields[2])
+		motifSeq =     fields[3]
+		strand   =     fields[5] if (len(fields) >= 6) else None
+	except ValueError:
+		assert (False), \
+		      "bad line, interval is not integers (line %s in %s):\n%s" \
+		    % (lineNumber,fName,line)
 
-		if (m == None):
-			break
+	assert (start < end), \
+	      "bad line, empty interval (line %s in %s):\n%s" \
+	    % (lineNumber,fName,line)
 
-		loop = m.group("loop")
-		stem = m.group("stem")
-		leftover = leftover[len(loop)+len(stem):]
-		parts.loop += [loop]
-		parts.stem += [stem]
+	if (allowBadLength):
+		if (len(motifSeq) != end-start): end = start + len(motifSeq)
+	else:
+		assert (len(motifSeq) == end-start), \
+		      "bad line, sequence length doesn't match interval length (line %s in %s):\n%s" \
+		    % (lineNumber,fName,line)
 
-	# if there's still any left over, try to re-parse it, in combination with
-	# the final stem, into a longer stem; this is to resolve the issue of the
-	# shortest match use above not including everything it might in the final
-	# stem
+	assert (strand in [None,"+","-"]), \
+	      "bad line, strand is not + nor - (line %s in %s):\n%s" \
+	    % (lineNumber,fName,line)
 
-	if (leftover != ""):
-		stemPlusLeftover = parts.stem[-1] + leftover
+	g4 = GQuad()
+	g4.line     = " ".join(line.split())
+	g4.chrom    = chrom
+	g4.start    = start
+	g4.end      = end
+	g4.strand   = strand
+	g4.motifSeq = motifSeq
+	return g4
 
-		m = stemLongest.match(stemPlusLeftover)
 
-		if (m == None):
-			m = stemLongLoopLongest.match(stemPlusLeftover)
-			if (m != None): hasLongLoop = True
+# read_gquad_bed_mapped--
+#	Same as read_gquad_bed, but for a regular file, which we memory-map.
+#
+# Reading starts at the file's current position. Each line is matched in
+# place against bedLineFields, so only the columns we use are copied into
+# python strings; the record's line (used for --copyinput and messages) is
+# built from the mapped buffer only if someone asks for it. Any line that
+# doesn't fit the simple pattern, or fails validation, is handed to
+# gquad_from_line, so comments and errors are treated exactly as they are by
+# read_gquad_bed.
+#
+# If tally is given, its bytesRead is kept up to date.
 
-		if (m != None):
-			stem = m.group("stem")
-			leftover = stemPlusLeftover[len(stem):]
-			parts.stem[-1] = stem
+bedLineFields = re_compile("[ \t\r\f\v]*([^#\s]\S*)\s+(\S+)\s+(\S+)\s+(\S+)"
+                         + "(?:\s+\S+(?:\s+(\S+)(?:\s+\S+)?)?)?\s*$")
 
-	return leftover
+class MappedGQuad(object):
+	__slots__ = ["buffer","lineStart","lineEnd","chrom","start","end","strand","motifSeq"]
 
+	@property
+	def line(self):
+		return " ".join(self.buffer[self.lineStart:self.lineEnd].split())
 
-# read_gquad_bed--
-#	Yield the next g-quadruplex from a bed file
+def read_gquad_bed_mapped(f,fName=None,allowBadLength=False,tally=None):
+	if (fName == None): fName = "input"
 
-class GQuad: pass
+	fd     = f.fileno()
+	offset = lseek(fd,0,SEEK_CUR)
+	if (fstat(fd).st_size <= offset): return
+	mapped = mmap(fd,0,access=ACCESS_READ)
+	size   = len(mapped)
+	match  = bedLineFields.match
+	find   = mapped.find
 
-def read_gquad_bed(f,fName=None):
-	if (fName == None): fName = "input"
+	lineNumber = 0
+	pos = offset
+	while (pos < size):
+		lineNumber += 1
+		lineEnd = find("\n",pos)
+		if (lineEnd < 0): lineEnd = nextPos = size
+		else:             nextPos = lineEnd + 1
+		if (tally != None): tally.bytesRead = nextPos - offset
 
+		m = match(mapped,pos,lineEnd)
+		g4 = None
+		if (m != None):
+			try:
+				(chrom,start,end,motifSeq) = m.group(1,2,3,4)
+				(start,end) = (int(start),int(end))
+				strand = m.group(5)
+			except ValueError:
+				start = end = None
+			if (start != None) and (start < end) \
+			  and (strand in [None,"+","-"]) \
+			  and ((allowBadLength) or (len(motifSeq) == end-start)):
+				g4 = MappedGQuad()
+				g4.buffer    = mapped
+				g4.lineStart = pos
+				g4.lineEnd   = lineEnd
+				g4.chrom     = chrom
+				g4.start     = start
+				g4.end       = start + len(motifSeq)
+				g4.strand    = strand
+				g4.motifSeq  = motifSeq
+
+		if (g4 == None):
+			g4 = gquad_from_line(mapped[pos:lineEnd],lineNumber,fName,allowBadLength)
+
+		pos = nextPos
+		if (g4 != None): yield g4
+
+
+# WindowTally--
+#	Accumulate, for each genomic window, the number of motifs (parsed and
+#	unparsed), and the number and total length of stems, loops and tails.
+#
+# Windows are either fixed-size, starting at zero, or taken from a list of
+# (chrom,start,end). Only the current chromosome's counts are held in
+# memory; they are written when the chromosome changes, so the input must be
+# grouped by chromosome (it needn't be sorted within a chromosome).
+#
+# A motif or part is counted in the window containing its start, while its
+# bases are divided among all the windows it overlaps. Overlapping parts are
+# not merged, so a base can contribute to a window's length more than once.
+# For fixed-size windows, every window from zero through the last one with
+# anything in it is written; for listed windows, every listed window is
+# written, including those on chromosomes with no motifs.
+
+windowColumns = ["motifs","unparsed","stems","stemBp","loops","loopBp","tails","tailBp"]
+windowCountIx = {"stem":2,"loop":4,"tail":6}
+
+class WindowTally:
+	def __init__(self,f=None,windowSize=None,windows=None):
+		assert (windowSize == None) != (windows == None)
+		self.f          = f
+		self.windowSize = windowSize
+		self.windows    = None
+		self.chromOrder = []
+		if (windows != None):
+			self.windows = {}
+			for (chrom,start,end) in windows:
+				if (chrom not in self.windows):
+					self.windows[chrom] = []
+					self.chromOrder += [chrom]
+				self.windows[chrom] += [(start,end)]
+			for chrom in self.chromOrder:
+				self.windows[chrom].sort()
+				for ix in xrange(1,len(self.windows[chrom])):
+					(prevStart,prevEnd) = self.windows[chrom][ix-1]
+					(start,end)         = self.windows[chrom][ix]
+					assert (prevEnd <= start), \
+					      "windows overlap: %s %d %d and %s %d %d" \
+					    % (chrom,prevStart,prevEnd,chrom,start,end)
+		self.chrom       = None
+		self.chromsSeen  = set()
+		self.wroteHeader = False
+		self.counts      = None
+
+	def start_chrom(self,chrom):
+		if (chrom == self.chrom): return
+		if (self.chrom != None): self.flush()
+		assert (chrom not in self.chromsSeen), \
+		      "input is not grouped by chromosome (%s appears again)" % chrom
+		self.chromsSeen.add(chrom)
+		self.chrom  = chrom
+		self.counts = {}
+		if (self.windows != None):
+			chromWindows = self.windows.get(chrom,[])
+			self.winStarts = [start for (start,_) in chromWindows]
+			self.winEnds   = [end   for (_,end)   in chromWindows]
+
+	# window_overlaps--
+	#	Yield (windowIx,overlap) for each window overlapping an interval.
+
+	def window_overlaps(self,start,end):
+		if (self.windows == None):
+			size = self.windowSize
+			for winIx in xrange(start//size,(end-1)//size+1):
+				winStart = winIx * size
+				yield (winIx,min(end,winStart+size)-max(start,winStart))
+		else:
+			winIx = max(0,bisect_right(self.winStarts,start)-1)
+			while (winIx < len(self.winStarts)) and (self.winStarts[winIx] < end):
+				overlap = min(end,self.winEnds[winIx]) - max(start,self.winStarts[winIx])
+				if (overlap > 0): yield (winIx,overlap)
+				winIx += 1
+
+	def window_of(self,pos):
+		if (self.windows == None):
+			return pos // self.windowSize
+		winIx = bisect_right(self.winStarts,pos) - 1
+		if (winIx < 0) or (pos >= self.winEnds[winIx]): return None
+		return winIx
+
+	def window_counts(self,winIx):
+		if (winIx not in self.counts): self.counts[winIx] = [0] * len(windowColumns)
+		return self.counts[winIx]
+
+	def add_motif(self,chrom,start,end,intervals):
+		self.start_chrom(chrom)
+		winIx = self.window_of(start)
+		if (winIx != None): self.window_counts(winIx)[0] += 1
+		for (partStart,partEnd,kind,_,_) in intervals:
+			countIx = windowCountIx[kind]
+			winIx = self.window_of(partStart)
+			if (winIx != None): self.window_counts(winIx)[countIx] += 1
+			for (winIx,overlap) in self.window_overlaps(partStart,partEnd):
+				self.window_counts(winIx)[countIx+1] += overlap
+
+	def add_unparsed(self,chrom,start,end):
+		self.start_chrom(chrom)
+		winIx = self.window_of(start)
+		if (winIx != None):
+			counts = self.window_counts(winIx)
+			counts[0] += 1
+			counts[1] += 1
+
+	def write(self,chrom,start,end,counts):
+		if (not self.wroteHeader):
+			self.write_line("#chrom\tstart\tend\t" + "\t".join(windowColumns))
+			self.wroteHeader = True
+		self.write_line("%s\t%d\t%d\t%s" \
+		              % (chrom,start,end,"\t".join([str(c) for c in counts])))
+
+	def write_line(self,line):
+		if (self.f == None): print line
+		else:                self.f.write(line + "\n")
+
+	def flush(self):
+		zeros = [0] * len(windowColumns)
+		if (self.windows == None):
+			if (self.counts == {}): return
+			size = self.windowSize
+			for winIx in xrange(max(self.counts)+1):
+				self.write(self.chrom,winIx*size,(winIx+1)*size,self.counts.get(winIx,zeros))
+		else:
+			for winIx in xrange(len(self.winStarts)):
+				self.write(self.chrom,self.winStarts[winIx],self.winEnds[winIx],
+				           self.counts.get(winIx,zeros))
+		self.counts = {}
+
+	def finish(self):
+		if (self.chrom != None): self.flush()
+		self.chrom = None
+		if (self.windows != None):
+			for chrom in self.chromOrder:
+				if (chrom in self.chromsSeen): continue
+				for (start,end) in self.windows[chrom]:
+					self.write(chrom,start,end,[0] * len(windowColumns))
+		if (not self.wroteHeader):
+			self.write_line("#chrom\tstart\tend\t" + "\t".join(windowColumns))
+			self.wroteHeader = True
+
+
+# read_windows_bed--
+#	Read genomic windows from a bed file, as a list of (chrom,start,end).
+
+def read_windows_bed(f,fName=None):
+	if (fName == None): fName = "windows"
+
+	windows = []
 	lineNumber = 0
 	for line in f:
 		lineNumber += 1
 		line = line.strip()
-		if (line == "") or (line.startswith("#")):
+		if (line == "") or (line.startswith("#")) \
+		  or (line.startswith("track")) or (line.startswith("browser")):
 			continue
 
 		fields = line.split()
-		assert (len(fields) in [4,5,6,7]), \
-		      "wrong number of fields at line %s in %s (got %d expected 4, 5, 6, or 7):\n%s" \
+		assert (len(fields) >= 3), \
+		      "wrong number of fields at line %s in %s (got %d expected at least 3):\n%s" \
 		    % (lineNumber,fName,len(fields),line)
 
 		try:
-			chrom    =     fields[0]
-			start    = int(fields[1])
-			end      = int(fields[2])
-			motifSeq =     fields[3]
-			strand   =     fields[5] if (len(fields) >= 6) else None
+			chrom = fields[0]
+			start = int(fields[1])
+			end   = int(fields[2])
 		except ValueError:
 			assert (False), \
 			      "bad line, interval is not integers (line %s in %s):\n%s" \
@@ -867,28 +2176,373 @@ def read_gquad_bed(f,fName=None):
 		      "bad line, empty interval (line %s in %s):\n%s" \
 		    % (lineNumber,fName,line)
 
-		if (allowBadLength):
-			if (len(motifSeq) != end-start): end = start + len(motifSeq)
-		else:
-			assert (len(motifSeq) == end-start), \
-			      "bad line, sequence length doesn't match interval length (line %s in %s):\n%s" \
-			    % (lineNumber,fName,line)
+		windows += [(chrom,start,end)]
 
-		assert (strand in [None,"+","-"]), \
-		      "bad line, strand is not + nor - (line %s in %s):\n%s" \
-		    % (lineNumber,fName,line)
+	return windows
+
+
+# IndexedPartWriter--
+#	Write sub-annotation lines as a series of compressed blocks, ordered by
+#	position, along with an index of the blocks.
+#
+# Each block is a complete gzip member holding about blockSize bytes of
+# lines from a single chromosome, so the file as a whole can still be read
+# with zcat. The index, in <fileName>.idx, has one line per block giving its
+# chromosome, the smallest start and largest end of its lines, and its byte
+# offset and compressed length. query_indexed() uses it to decompress only
+# the blocks overlapping a region.
+#
+# Motifs must arrive grouped by chromosome and sorted by start. A motif's
+# parts all start at or after the motif's start, so any buffered line that
+# starts before the current motif is final and can be written; lines are
+# held in a heap only until then.
+
+indexedHeader = "#gee_kwad indexed sub-annotations, version 1"
+
+class IndexedPartWriter:
+	def __init__(self,fileName,blockSize=64*1024):
+		self.fileName   = fileName
+		self.indexName  = fileName + ".idx"
+		self.blockSize  = blockSize
+		self.f          = file(fileName,"wb")
+		self.index      = []      # list of (chrom,minStart,maxEnd,offset,length)
+		self.offset     = 0
+		self.chrom      = None
+		self.chromsSeen = set()
+		self.motifStart = None
+		self.pending    = []      # heap of (start,end,serialNum,line)
+		self.serialNum  = 0
+		self.block      = []
+		self.blockBytes = 0
+
+	def add_motif(self,chrom,motifStart,lines):
+		if (chrom != self.chrom):
+			self.release(None)
+			self.write_block()
+			assert (chrom not in self.chromsSeen), \
+			      "input is not grouped by chromosome (%s appears again)" % chrom
+			self.chromsSeen.add(chrom)
+			self.chrom      = chrom
+			self.motifStart = None
+
+		assert (self.motifStart == None) or (motifStart >= self.motifStart), \
+		      "input is not sorted by position (%s %d follows %s %d); sort it first, e.g. with sort -k1,1 -k2,2n" \
+		    % (chrom,motifStart,chrom,self.motifStart)
+		self.motifStart = motifStart
+
+		self.release(motifStart)
+		for (start,end,line) in lines:
+			self.serialNum += 1
+			heappush(self.pending,(start,end,self.serialNum,line))
+
+	# release--
+	#	Move pending lines that start before pos (or all of them, if pos is
+	#	None) into blocks.
+
+	def release(self,pos):
+		pending = self.pending
+		while (pending != []) and ((pos == None) or (pending[0][0] < pos)):
+			(start,end,_,line) = heappop(pending)
+			self.block += [(start,end,line)]
+			self.blockBytes += len(line) + 1
+			if (self.blockBytes >= self.blockSize):
+				self.write_block()
+
+	def write_block(self):
+		if (self.block == []): return
+		text   = "".join([line+"\n" for (_,_,line) in self.block])
+		zipper = compressobj(6,DEFLATED,16+MAX_WBITS)   # gzip format
+		data   = zipper.compress(text) + zipper.flush()
+		self.f.write(data)
+		minStart = self.block[0][0]
+		maxEnd   = max([end for (_,end,_) in self.block])
+		self.index += [(self.chrom,minStart,maxEnd,self.offset,len(data))]
+		self.offset += len(data)
+		self.block      = []
+		self.blockBytes = 0
+
+	def finish(self):
+		self.release(None)
+		self.write_block()
+		self.f.close()
+
+		f = file(self.indexName,"wt")
+		print >>f, indexedHeader
+		for (chrom,minStart,maxEnd,offset,length) in self.index:
+			print >>f, "%s\t%d\t%d\t%d\t%d" % (chrom,minStart,maxEnd,offset,length)
+		f.close()
+
+
+# query_indexed--
+#	Yield (chrom,start,end,line) for each sub-annotation in an indexed file
+#	that overlaps the region chrom:start-end (origin-zero, half-open); if
+#	start and end are None, the whole chromosome is returned.
+
+def query_indexed(fileName,chrom,start=None,end=None):
+	blocks = []
+	f = file(fileName+".idx","rt")
+	header = f.readline().rstrip("\n")
+	assert (header == indexedHeader), \
+	      "%s.idx is not a %s index" % (fileName,programName)
+	for line in f:
+		(blockChrom,minStart,maxEnd,offset,length) = line.split()
+		if (blockChrom != chrom): continue
+		if (start != None) and ((int(minStart) >= end) or (int(maxEnd) <= start)):
+			continue
+		blocks += [(int(offset),int(length))]
+	f.close()
+
+	f = file(fileName,"rb")
+	for (offset,length) in blocks:
+		f.seek(offset)
+		text = decompress(f.read(length),16+MAX_WBITS)
+		for line in text.splitlines():
+			fields = line.split("\t",3)
+			(partStart,partEnd) = (int(fields[1]),int(fields[2]))
+			if (start != None) and ((partStart >= end) or (partEnd <= start)):
+				continue
+			yield (fields[0],partStart,partEnd,line)
+	f.close()
 
-		g4 = GQuad()
-		g4.line     = " ".join(line.split())
-		g4.chrom    = chrom
-		g4.start    = start
-		g4.end      = end
-		g4.strand   = strand
-		g4.motifSeq = motifSeq
-		yield g4
 
+# parse_region--
+#	Parse a region string, chrom:start-end (1-based, inclusive, commas
+#	allowed) or just chrom, into (chrom,start,end) with origin-zero,
+#	half-open coordinates (start and end are None for a bare chrom).
 
-# reverse_complement--
+def parse_region(s):
+	if (":" not in s):
+		if (s == ""): raise ValueError
+		return (s,None,None)
+	(chrom,interval) = s.rsplit(":",1)
+	(start,end) = interval.replace(",","").split("-",1)
+	(start,end) = (int(start)-1,int(end))
+	if (chrom == "") or (start < 0) or (start >= end): raise ValueError
+	return (chrom,start,end)
+
+
+# Telemetry--
+#	Periodically write machine-readable throughput statistics, one JSON
+#	object per line.
+#
+# Each report covers the records and input bytes processed in the last
+# interval and in total, an estimated time to completion (when the input size
+# is known), the process's resident memory, and the slowest records seen so
+# far. The time charged to a record runs from when it is read until the next
+# record is read, so it includes parsing and output. A final report, marked
+# with "final":true, is written by finish().
+
+class Telemetry:
+	def __init__(self,f,interval=10.0,numSlowest=5,inputSize=None):
+		self.f            = f
+		self.interval     = interval
+		self.numSlowest   = numSlowest
+		self.inputSize    = inputSize
+		self.cacheStats   = None    # a function returning (hits,misses)
+		self.bytesRead    = 0
+		self.records      = 0
+		self.slowest      = []      # heap of (seconds,chrom,start,end)
+		self.startTime    = time()
+		self.reportTime   = self.startTime
+		self.reportRecs   = 0
+		self.reportBytes  = 0
+		self.current      = None
+		self.currentStart = None
+
+	def count_input(self,f):
+		for line in f:
+			self.bytesRead += len(line)
+			yield line
+
+	def tick(self,g4):
+		t = time()
+		self.record_done(t)
+		self.current      = g4
+		self.currentStart = t
+		if (t - self.reportTime >= self.interval):
+			self.report(t)
+
+	def record_done(self,t):
+		if (self.current == None): return
+		self.records += 1
+		g4 = self.current
+		item = (t-self.currentStart,g4.chrom,g4.start,g4.end)
+		if (len(self.slowest) < self.numSlowest):
+			heappush(self.slowest,item)
+		elif (self.numSlowest > 0) and (item > self.slowest[0]):
+			heappushpop(self.slowest,item)
+		self.current = None
+
+	def finish(self):
+		t = time()
+		self.record_done(t)
+		self.report(t,final=True)
+
+	def report(self,t,final=False):
+		intervalSecs = t - self.reportTime
+		totalSecs    = t - self.startTime
+		intervalRecs = self.records   - self.reportRecs
+		intervalBytes= self.bytesRead - self.reportBytes
+
+		info = {}
+		info["time"]          = round(t,3)
+		info["elapsedSecs"]   = round(totalSecs,3)
+		info["intervalSecs"]  = round(intervalSecs,3)
+		info["recordsPerSec"] = per_second(intervalRecs,intervalSecs)
+		info["bytesPerSec"]   = per_second(intervalBytes,intervalSecs)
+		info["records"]       = self.records
+		info["bytes"]         = self.bytesRead
+		info["inputBytes"]    = self.inputSize
+		info["etaSecs"]       = None
+		if (self.inputSize != None) and (self.bytesRead > 0):
+			bytesLeft = max(0,self.inputSize-self.bytesRead)
+			info["etaSecs"] = round(bytesLeft * totalSecs / self.bytesRead,1)
+		info["rssBytes"]      = resident_memory()
+		if (self.cacheStats != None):
+			(hits,misses) = self.cacheStats()
+			info["cacheHitRate"] = None if (hits+misses == 0) \
+			                       else round(float(hits)/(hits+misses),4)
+		info["slowest"] = [{"chrom":chrom,"start":start,"end":end,
+		                    "secs":round(secs,6)}
+		                   for (secs,chrom,start,end) in sorted(self.slowest,reverse=True)]
+		if (final): info["final"] = True
+
+		self.f.write(json_dumps(info,sort_keys=True) + "\n")
+		self.f.flush()
+
+		self.reportTime  = t
+		self.reportRecs  = self.records
+		self.reportBytes = self.bytesRead
+
+
+# SamplingProfiler--
+#	Attribute cpu time to functions by sampling the call stack.
+#
+# Every interval seconds of cpu time (ITIMER_PROF), the stack of python frames
+# that was interrupted is recorded. Time spent inside C code (the regex
+# engine, string methods, file writes) is charged to the python function that
+# called it; e.g. regex matching shows up as MotifMatcher.match.
+#
+# The timer may fire less often than asked (it is limited by the kernel's
+# clock tick), so seconds are reported as each function's share of the
+# samples times the cpu time actually used while sampling.
+#
+# write_table() writes one line per function: the percentage and seconds of
+# samples in which the function was running itself (self) and in which it was
+# anywhere on the stack (total), most self time first. Columns are separated
+# by whitespace, so the table can be re-sorted with e.g. "sort -k3,3nr".
+# write_folded() writes one line per distinct stack, outermost function
+# first, separated by semicolons, followed by the number of samples; this is
+# the input expected by flamegraph.pl and similar tools.
+
+class SamplingProfiler:
+	def __init__(self,interval=0.001):
+		self.interval = interval
+		self.stacks   = {}   # maps a tuple of code objects (innermost first) to
+		                     # .. its number of samples
+		self.samples  = 0
+		self.cpuStart = None
+		self.cpuSecs  = 0.0
+
+	def start(self):
+		self.cpuStart = cpu_seconds()
+		signal(SIGPROF,self.sample)
+		siginterrupt(SIGPROF,False)   # (so reads and writes aren't interrupted)
+		setitimer(ITIMER_PROF,self.interval,self.interval)
+
+	def stop(self):
+		setitimer(ITIMER_PROF,0,0)
+		signal(SIGPROF,SIG_DFL)
+		self.cpuSecs = cpu_seconds() - self.cpuStart
+
+	def sample(self,signum,frame):
+		stack = []
+		while (frame != None):
+			stack += [frame.f_code]
+			frame = frame.f_back
+		stack = tuple(stack)
+		self.stacks[stack] = self.stacks.get(stack,0) + 1
+		self.samples += 1
+
+	def write_table(self,f):
+		selfCount  = {}
+		totalCount = {}
+		for (stack,count) in self.stacks.items():
+			selfCount[stack[0]] = selfCount.get(stack[0],0) + count
+			for code in set(stack):
+				totalCount[code] = totalCount.get(code,0) + count
+
+		print >>f, "# %s samples, %s seconds of cpu time" \
+		         % (commatize(self.samples),"%.3f" % self.cpuSecs)
+		print >>f, "#%6s %9s %7s %9s  %s" % ("self%","selfSecs","total%","totalSecs","function")
+		if (self.samples == 0): return
+		secsPerSample = self.cpuSecs / self.samples
+		order = [(-selfCount.get(code,0),-totalCount[code],code_label(code),code)
+		         for code in totalCount]
+		order.sort()
+		for (_,_,label,code) in order:
+			(selfN,totalN) = (selfCount.get(code,0),totalCount[code])
+			print >>f, "%7.2f %9.3f %7.2f %9.3f  %s" \
+			         % (100.0*selfN/self.samples,  selfN*secsPerSample,
+			            100.0*totalN/self.samples, totalN*secsPerSample,
+			            label)
+
+	def write_folded(self,f):
+		lines = []
+		for (stack,count) in self.stacks.items():
+			lines += [(";".join([code_label(code) for code in stack[::-1]]),count)]
+		lines.sort()
+		for (line,count) in lines:
+			print >>f, "%s %d" % (line,count)
+
+
+def code_label(code):
+	return "%s (%s:%d)" % (code.co_name,basename(code.co_filename),code.co_firstlineno)
+
+
+def cpu_seconds():
+	(user,system) = times()[:2]
+	return user + system
+
+
+def per_second(count,secs):
+	if (secs <= 0): return None
+	return round(count/secs,1)
+
+
+# regular_file_size--
+#	Return the size of an open file, or None if it isn't a regular file (e.g.
+#	it's a pipe).
+
+def regular_file_size(f):
+	try:
+		info = fstat(f.fileno())
+	except (AttributeError,ValueError,OSError):
+		return None
+	if (not S_ISREG(info.st_mode)): return None
+	return info.st_size
+
+
+# resident_memory--
+#	Return the current resident set size of this process, in bytes; on
+#	systems without /proc, this falls back to the peak resident set size.
+
+def resident_memory():
+	try:
+		f = file("/proc/self/statm","rt")
+		fields = f.read().split()
+		f.close()
+		return int(fields[1]) * sysconf("SC_PAGE_SIZE")
+	except (IOError,OSError,IndexError,ValueError):
+		pass
+	try:
+		from resource import getrusage,RUSAGE_SELF
+		return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+	except ImportError:
+		return None
+
+
+# reverse_complement, complement--
 
 complementMap = maketrans("ACGTSWRYMKBDHVNacgtswrymkbdhvn",
                           "TGCASWYRKMVHDBNtgcaswyrkmvhdbn")
@@ -896,6 +2550,9 @@ complementMap = maketrans("ACGTSWRYMKBDHVNacgtswrymkbdhvn",
 def reverse_complement(nukes):
 	return nukes[::-1].translate(complementMap)
 
+def complement(nukes):
+	return nukes.translate(complementMap)
+
 
 # int_with_unit--
 #	Parse a string as an integer, allowing unit suffixes
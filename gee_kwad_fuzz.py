@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+"""
+Differential fuzzing of gee_kwad's parse engines against the regex reference.
+"""
+
+from sys          import argv,stdout,stderr,exit
+from random       import Random
+from time         import time
+from imp          import load_source
+from gee_kwad     import GQuadParser,gQuadEngines,reverse_complement,complement, \
+                         int_with_unit,commatize
+
+
+programName    = "gee_kwad_fuzz"
+programVersion = "0.1.0"
+
+referenceEngine = "regex"
+cacheSizes      = [0,256]
+
+
+def usage(s=None):
+	message = """
+Check that gee_kwad's faster parse engines reproduce the reference (regex)
+engine exactly, on random and edge-case motifs.
+
+usage: %s [options]
+  --seed=<number>      seed for the random motif generator (by default a seed
+                       is chosen from the clock, and reported)
+  --cases=<number>     number of motifs to generate (default is 1M)
+  --engine=<engines>   comma-separated list of engines to check against the
+                       reference (default is all of them: %s)
+  --baseline=<file>    also time the parser of an earlier gee_kwad.py, e.g.
+                       the one from before the parse engines were added; its
+                       results aren't checked, since that version can raise
+                       an exception on some bulged motifs
+  --nominimize         report a divergence as found, without shrinking it
+  --progress=<number>  periodically report how many motifs we've checked
+  --version            show version number and quit
+
+Each motif is parsed, on a random choice of strand (+, -, or unspecified),
+with every combination of --allow:bulges, --disallow:gloop,
+--parse=fourstems and --cache (sizes %s). Each parse is done both with and
+without allowMirrored (in alternating order, so that with a cache both hit
+the cache half the time); a mirrored result is complemented before it is
+compared. We stop at the first motif for which some engine's parse differs
+from the reference's, shrink the motif to a small one that still differs,
+and report it as a bed line along with the gee_kwad command that shows the
+difference. Otherwise we report the relative speed of each engine.""" \
+% (programName,",".join(candidate_engines()),
+   ",".join(["%d" % cacheSize for cacheSize in cacheSizes]))
+
+	if (s == None): exit (message)
+	else:           exit ("%s\n%s" % (s,message))
+
+
+def candidate_engines():
+	return [engine for engine in gQuadEngines if (engine != referenceEngine)]
+
+
+def main():
+
+	# parse the command line
+
+	seed           = None
+	numCases       = 1000*1000
+	engines        = candidate_engines()
+	baselineName   = None
+	minimize       = True
+	reportProgress = None
+
+	for arg in argv[1:]:
+		if ("=" in arg):
+			argVal = arg.split("=",1)[1]
+
+		if (arg.startswith("--seed=")):
+			seed = int(argVal)
+		elif (arg.startswith("--cases=")):
+			numCases = int_with_unit(argVal)
+		elif (arg.startswith("--engine=")) or (arg.startswith("--engines=")):
+			engines = argVal.split(",")
+			for engine in engines:
+				if (engine not in gQuadEngines):
+					usage("unknown engine: %s" % engine)
+		elif (arg.startswith("--baseline=")):
+			baselineName = argVal
+		elif (arg in ["--nominimize","--nominimise"]):
+			minimize = False
+		elif (arg.startswith("--progress=")):
+			reportProgress = int_with_unit(argVal)
+		elif (arg in ["--version","--v","--V","-version","-v","-V"]):
+			exit("%s, version %s" % (programName,programVersion))
+		elif (arg.startswith("--")):
+			usage("unrecognized option: %s" % arg)
+		else:
+			usage("unrecognized option: %s" % arg)
+
+	if (seed == None):
+		seed = int(time()*1000) % 1000000007
+
+	# build a parser for every engine and option set
+
+	engines = [referenceEngine] + [engine for engine in engines if (engine != referenceEngine)]
+
+	baseline = None
+	if (baselineName != None):
+		try:
+			baseline = load_source("gee_kwad_baseline",baselineName)
+		except (IOError,SyntaxError), ex:
+			usage("unable to load baseline %s (%s)" % (baselineName,ex))
+		engines += ["baseline"]
+
+	optionSets = []
+	for allowBulges in [False,True]:
+		for allowGLoops in [True,False]:
+			for parseAs in ["latest version","4 stems"]:
+				for cacheSize in cacheSizes:
+					options = []
+					if (allowBulges):         options += ["--allow:bulges"]
+					if (not allowGLoops):     options += ["--disallow:gloop"]
+					if (parseAs == "4 stems"): options += ["--parse=fourstems"]
+					if (cacheSize > 0):       options += ["--cache=%d" % cacheSize]
+					parsers = [GQuadParser(allowBulges=allowBulges,
+					                       allowGLoops=allowGLoops,
+					                       parseAs=parseAs,
+					                       engine=engine,
+					                       cacheSize=cacheSize)
+					           for engine in engines if (engine != "baseline")]
+					if (baseline != None):
+						parsers += [BaselineParser(baseline,allowBulges,allowGLoops,parseAs)]
+					optionSets += [(options,parsers)]
+
+	print "seed %d, %s motifs, %d option sets, engines %s" \
+	    % (seed,commatize(numCases),len(optionSets),",".join(engines))
+	stdout.flush()
+
+	# check the motifs
+
+	generator   = MotifGenerator(seed)
+	engineSecs  = [0.0] * len(engines)
+	engineCalls = 0
+
+	for (caseNum,(seq,strand)) in enumerate(generator.motifs(numCases)):
+		if (reportProgress != None) and (caseNum > 0) and (caseNum % reportProgress == 0):
+			print >>stderr, "progress: motif %s" % commatize(caseNum)
+
+		mirroredFirst = (caseNum % 2 == 1)
+		for (options,parsers) in optionSets:
+			results = []
+			for (engineIx,parser) in enumerate(parsers):
+				t = time()
+				result = parse_results(parser,seq,strand,mirroredFirst)
+				engineSecs[engineIx] += time() - t
+				results += [result]
+			engineCalls += 1
+
+			for engineIx in xrange(1,len(engines)):
+				if (engines[engineIx] == "baseline"): continue
+				if (results[engineIx] == results[0]): continue
+				(refParser,testParser) = (parsers[0],parsers[engineIx])
+				shrunk = seq
+				if (minimize):
+					shrunk = minimize_divergence(refParser,testParser,seq,strand,mirroredFirst)
+				report_divergence(caseNum,seq,shrunk,strand,mirroredFirst,options,
+				                  engines[0],refParser,engines[engineIx],testParser)
+				exit(1)
+
+	# report relative speed
+
+	print "no divergences in %s motifs (%s parses per engine)" \
+	    % (commatize(numCases),commatize(engineCalls))
+	refSecs = engineSecs[0]
+	baseSecs = engineSecs[-1] if (baseline != None) else None
+	for (engineIx,engine) in enumerate(engines):
+		secs = engineSecs[engineIx]
+		rate = engineCalls/secs if (secs > 0) else float("inf")
+		relative = refSecs/secs if (secs > 0) else float("inf")
+		line = "%-8s %8.2f secs %12s parses/sec %6.2fx reference" \
+		     % (engine,secs,commatize("%.0f" % rate),relative)
+		if (baseSecs != None):
+			relative = baseSecs/secs if (secs > 0) else float("inf")
+			line += " %6.2fx baseline" % relative
+		print line
+
+
+# parse_results--
+#	Parse a motif both without and with allowMirrored (in the order given by
+#	mirroredFirst), returning the pair of results, without allowMirrored
+#	first.
+
+def parse_results(parser,seq,strand,mirroredFirst=False):
+	if (mirroredFirst):
+		mirroredResult = parse_result(parser,seq,strand,allowMirrored=True)
+		result         = parse_result(parser,seq,strand)
+	else:
+		result         = parse_result(parser,seq,strand)
+		mirroredResult = parse_result(parser,seq,strand,allowMirrored=True)
+	return (result,mirroredResult)
+
+
+# parse_result--
+#	Parse a motif, returning a comparable summary of the result; an exception
+#	raised by the parser is part of the result. Mirrored parts are
+#	complemented, so that the summary is the same as without allowMirrored.
+
+def parse_result(parser,seq,strand,allowMirrored=False):
+	try:
+		parts = parser.parse_record("chrF",0,len(seq),seq,strand,
+		                            allowMirrored=allowMirrored)
+	except Exception, ex:
+		return ("exception",ex.__class__.__name__,str(ex))
+	if (parts == None): return None
+	(stems,loops,tail) = (parts.stem,parts.loop,parts.tail)
+	if (parts.mirrored):
+		stems = map(complement,stems)
+		loops = map(complement,loops)
+		if (tail != None): tail = complement(tail)
+	return (parts.strand,tuple(stems),tuple(loops),tail,
+	        parts.hasLongLoop,parts.hasBulge)
+
+
+# BaselineParser--
+#	Adapt the module-level parser of an earlier gee_kwad.py (which reads its
+#	options from module globals) to the parse_record interface, with the
+#	strand handling of that version's main().
+
+class BaselineParser:
+	def __init__(self,module,allowBulges,allowGLoops,parseAs):
+		self.module      = module
+		self.allowBulges = allowBulges
+		self.allowGLoops = allowGLoops
+		self.parse       = module.parse_as_g_quad_4_stems if (parseAs == "4 stems") \
+		              else module.parse_as_g_quad
+
+	def parse_record(self,chrom,start,end,seq,strand=None,allowMirrored=False):
+		module = self.module
+		module.allowBulges = self.allowBulges
+		module.allowGLoops = self.allowGLoops
+		module.debug       = []
+
+		if (strand == "+"):
+			parts = self.parse(seq)
+		elif (strand == "-"):
+			parts = self.parse(module.reverse_complement(seq))
+		else: # if (strand == None):
+			strand = "+"
+			parts = self.parse(seq)
+			if (parts == None):
+				strand = "-"
+				parts = self.parse(module.reverse_complement(seq))
+
+		if (parts == None): return None
+		parts.mirrored = False
+		parts.strand   = strand
+		return parts
+
+
+# minimize_divergence--
+#	Shrink a motif on which two parsers differ to a (locally) minimal one on
+#	which they still differ. We delete ever smaller chunks of the sequence,
+#	then try simplifying each remaining base (to upper case, and non-G bases
+#	to T), repeating until nothing more can be removed or simplified.
+
+def minimize_divergence(refParser,testParser,seq,strand,mirroredFirst=False):
+	differs = lambda s: (s != "") \
+	                and (parse_results(refParser,s,strand,mirroredFirst) \
+	                  != parse_results(testParser,s,strand,mirroredFirst))
+
+	changed = True
+	while (changed):
+		changed = False
+
+		chunk = len(seq) // 2
+		while (chunk >= 1):
+			ix = 0
+			while (ix < len(seq)):
+				candidate = seq[:ix] + seq[ix+chunk:]
+				if (differs(candidate)):
+					seq = candidate
+					changed = True
+				else:
+					ix += chunk
+			chunk //= 2
+
+		simpleBase = "G" if (strand != "-") else "C"
+		for ix in xrange(len(seq)):
+			nuc = seq[ix]
+			simplers = [nuc.upper()]
+			if (nuc.upper() != simpleBase): simplers += ["T"]
+			for simpler in simplers:
+				if (simpler == nuc): continue
+				candidate = seq[:ix] + simpler + seq[ix+1:]
+				if (differs(candidate)):
+					seq = candidate
+					nuc = simpler
+					changed = True
+
+	return seq
+
+
+# report_divergence--
+
+def report_divergence(caseNum,seq,shrunk,strand,mirroredFirst,options,
+                      refEngine,refParser,testEngine,testParser):
+	print "divergence at motif %s (%s, engine %s)" \
+	    % (commatize(caseNum+1)," ".join(options) if (options != []) else "default options",testEngine)
+	print "  original:  %s (%d bp)" % (seq,len(seq))
+	if (shrunk != seq):
+		print "  minimized: %s (%d bp)" % (shrunk,len(shrunk))
+	refResults  = parse_results(refParser, shrunk,strand,mirroredFirst)
+	testResults = parse_results(testParser,shrunk,strand,mirroredFirst)
+	for (resultIx,how) in enumerate(["","(allowMirrored)"]):
+		if (refResults[resultIx] == testResults[resultIx]): continue
+		print "  %-9s  %s %s" % (refEngine+":", describe_result(refResults[resultIx]), how)
+		print "  %-9s  %s %s" % (testEngine+":",describe_result(testResults[resultIx]),how)
+
+	bedLine = "chrF\\t0\\t%d\\t%s" % (len(shrunk),shrunk)
+	if (strand != None): bedLine += "\\t%d\\t%s" % (len(shrunk),strand)
+	for engine in [refEngine,testEngine]:
+		print "  reproduce: printf \"%s\\n\" | gee_kwad.py --engine=%s%s" \
+		    % (bedLine,engine,"".join([" "+option for option in options]))
+
+
+def describe_result(result):
+	if (result == None): return "(no parse)"
+	if (result[0] == "exception"): return "%s: %s" % (result[1],result[2])
+	(strand,stems,loops,tail,hasLongLoop,hasBulge) = result
+	s = "%s stems=%s loops=%s" % (strand,",".join(stems),",".join(loops))
+	if (tail != None): s += " tail=%s" % tail
+	if (hasLongLoop):  s += " longloop"
+	if (hasBulge):     s += " bulge"
+	return s
+
+
+# MotifGenerator--
+#	Generate random motifs, as (seq,strand) pairs, from a seeded generator.
+#
+# The first motifs are a fixed list of edge cases. After that, most motifs are
+# built as g-quadruplexes, a random number of G-runs separated by loops, with
+# random bulges, G-loops, long loops, tails, N bases and lower case; the rest
+# are unstructured soup, weighted toward G. A motif on the minus strand (or
+# sometimes one with no strand given) is reverse-complemented.
+
+class MotifGenerator:
+	edgeCases = ["G","GG","GGG","GGGG","GGGGGGG","GGGGGGGGGGGG","GGGGGGGGGGGGGGGG",
+	             "GGGAGGGAGGGAGGG","gggagggagggaggg","GGGNGGGNGGGNGGG",
+	             "GGGGGGAGGGAGGGAGGG","GGGAGGGAGGGAGGGGGG","GGGGAGGGAGGGAGGGG",
+	             "GGGAGGGAGGG","GGGAGGG","AGGGAGGGAGGGAGGGA","AAGGGAGGGAGGGAGGG",
+	             "GGGAGGGAGGGAGGGAA","GGGAGGGGGGGAGGG","GGGGGGGGAGGGAGGG",
+	             "GGGTTGGGTTGGGTTGGGTTGGG","GGG" + "A"*40 + "GGGAGGGAGGG",
+	             "GGGAGGG" + "T"*30 + "GGGAGGG","GAGGAGGGAGGG","GGAGGGAGGGAGGAG",
+	             "GGGCGGGGGTTGGGGGGG","GGGCTGGGGCGGGGGGAGGG","NNNNNNNN","ACGT"]
+
+	def __init__(self,seed):
+		self.rng = Random(seed)
+
+	def motifs(self,numCases):
+		rng = self.rng
+		for caseNum in xrange(numCases):
+			if (caseNum < 3*len(self.edgeCases)):
+				seq    = self.edgeCases[caseNum // 3]
+				strand = ["+","-",None][caseNum % 3]
+			else:
+				seq    = self.g_quad() if (rng.random() < 0.85) else self.soup()
+				strand = rng.choice(["+","+","-","-",None])
+			if (strand == "-") or ((strand == None) and (rng.random() < 0.5)):
+				seq = reverse_complement(seq)
+			yield (seq,strand)
+
+	def g_quad(self):
+		rng = self.rng
+		numStems = rng.choice([1,2,2,3,3,4,4,4,4,4,5,5,6,7])
+		runLength = rng.randint(1,6)
+		pieces = [self.tail()]
+		for stemIx in xrange(numStems):
+			if (stemIx > 0): pieces += [self.loop()]
+			stemLength = runLength if (rng.random() < 0.7) else rng.randint(1,8)
+			stem = "G" * stemLength
+			if (stemLength >= 2) and (rng.random() < 0.15):
+				bulgeAt = rng.randint(1,stemLength-1)
+				stem = stem[:bulgeAt] + self.bases("ACTN",rng.randint(1,3)) + stem[bulgeAt:]
+			pieces += [stem]
+		pieces += [self.tail()]
+		return self.decorate("".join(pieces))
+
+	def loop(self):
+		rng = self.rng
+		r = rng.random()
+		if   (r < 0.08): return ""
+		elif (r < 0.20): return "G" * rng.randint(1,2)
+		elif (r < 0.30): return self.bases("ACGTN",rng.randint(8,45))
+		else:            return self.bases("ACTACTGN",rng.randint(1,7))
+
+	def tail(self):
+		rng = self.rng
+		if (rng.random() < 0.7): return ""
+		return self.bases("ACGTN",rng.randint(1,6))
+
+	def soup(self):
+		return self.decorate(self.bases("GGGGGGACTNC",self.rng.randint(1,60)))
+
+	def bases(self,alphabet,length):
+		choice = self.rng.choice
+		return "".join([choice(alphabet) for _ in xrange(length)])
+
+	def decorate(self,seq):
+		# scatter N bases, and lower-case a random stretch (or all of it)
+		rng = self.rng
+		if (seq == ""): return seq
+		if (rng.random() < 0.10):
+			seq = list(seq)
+			for _ in xrange(rng.randint(1,3)):
+				seq[rng.randrange(len(seq))] = "N"
+			seq = "".join(seq)
+		r = rng.random()
+		if (r < 0.05):
+			seq = seq.lower()
+		elif (r < 0.30):
+			start = rng.randrange(len(seq))
+			end   = rng.randint(start+1,len(seq))
+			seq   = seq[:start] + seq[start:end].lower() + seq[end:]
+		return seq
+
+
+if __name__ == "__main__": main()